@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 sts=4 et :
+
+"""How many pipelines each pair should have running, worked out from
+how often chunks are written to its pipelines, how long they wait for
+room in them and how long they take to get through.
+
+"""
+
+import math
+from time import time
+
+
+class PairLoad(object):
+    """Exponentially decaying averages of the traffic of one pair."""
+
+    def __init__(self, now):
+        self.last = now
+        # Decayed counts of arrivals; count/tau estimates the arrival
+        # rate over the last tau seconds:
+        self.counts = {tau: 0.0 for tau in Autoscaler.RATE_TAUS}
+        self.wait = 0.0
+        self.waitNoted = now
+        self.service = 0.0
+
+    def decay(self, now):
+        elapsed = max(0.0, now - self.last)
+        for tau in self.counts:
+            self.counts[tau] *= math.exp(-elapsed / tau)
+        self.last = now
+
+    def noteArrival(self, now):
+        self.decay(now)
+        for tau in self.counts:
+            self.counts[tau] += 1
+
+    def noteWait(self, seconds, now):
+        self.wait = self.currentWait(now) * (1 - Autoscaler.ALPHA) + seconds * Autoscaler.ALPHA
+        self.waitNoted = now
+
+    def noteService(self, seconds):
+        self.service = self.service * (1 - Autoscaler.ALPHA) + seconds * Autoscaler.ALPHA
+
+    def rate(self, tau, now):
+        return self.counts[tau] * math.exp(-max(0.0, now - self.last) / tau) / tau
+
+    def currentWait(self, now):
+        # Without new chunks, old waits shouldn't keep us scaling up:
+        return self.wait * math.exp(-max(0.0, now - self.waitNoted) / Autoscaler.SHORT)
+
+
+class Autoscaler(object):
+    """Per pair, we want enough pipelines that the chunks in flight
+    (arrival rate × time in the pipeline, by Little's law) come to at
+    most max_users_per_pipe per pipeline. We want one more if chunks
+    have lately had to wait over target_wait seconds for room in a
+    pipeline, if the least busy one has more than max_users_per_pipe
+    users, or if the pair's traffic is rising, so the new pipeline is
+    started before it is needed.
+
+    """
+
+    SHORT = 10  # seconds
+    LONG = 120
+    RATE_TAUS = (SHORT, LONG)
+    ALPHA = 0.2  # weight of new waits and service times
+    RISING = 1.5  # short-term rate over long-term rate for traffic to count as rising
+    MIN_RISING_RATE = 0.5  # chunks per second, below which we don't bother
+    COOLDOWN = 30  # seconds a surplus pipeline must be idle before shutting it down
+
+    def __init__(self, min_pipes=0, max_pipes=1, max_users=5, target_wait=0.05):
+        self.min_pipes = min_pipes
+        self.max_pipes = max_pipes
+        self.max_users = max_users
+        self.target_wait = target_wait
+        self.loads = {}  # pair: PairLoad
+
+    def load(self, pair, now):
+        if pair not in self.loads:
+            self.loads[pair] = PairLoad(now)
+        return self.loads[pair]
+
+    def noteStage(self, pair, stage, seconds, now=None):
+        """A stageTimer for the pipelines of pair (see metrics.stageTimer)."""
+        if now is None:
+            now = time()
+        load = self.load(pair, now)
+        if stage == 'queue':
+            load.noteArrival(now)
+            load.noteWait(seconds, now)
+        elif stage == 'pipeline':
+            load.noteService(seconds)
+
+    def rising(self, load, now):
+        short, long = load.rate(self.SHORT, now), load.rate(self.LONG, now)
+        return short >= self.MIN_RISING_RATE and short > self.RISING * long
+
+    def wanted(self, pair, running, leastUsers=0, now=None):
+        if now is None:
+            now = time()
+        wanted = 0
+        load = self.loads.get(pair)
+        if load is not None:
+            inFlight = load.rate(self.SHORT, now) * load.service
+            wanted = int(math.ceil(inFlight / max(1, self.max_users)))
+            if running and (load.currentWait(now) > self.target_wait > 0 or
+                            self.rising(load, now)):
+                wanted = max(wanted, running + 1)
+        if running and leastUsers > self.max_users:
+            wanted = max(wanted, running + 1)
+        return max(self.min_pipes, min(self.max_pipes, wanted))
+
+    def toJson(self, now=None):
+        if now is None:
+            now = time()
+        return {
+            '%s-%s' % pair: {
+                'chunksPerSec': round(load.rate(self.SHORT, now), 3),
+                'queueWait': round(load.currentWait(now), 4),
+                'pipelineTime': round(load.service, 4),
+                'rising': self.rising(load, now)
+            }
+            for pair, load in self.loads.items()
+        }
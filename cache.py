@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 sts=4 et :
+
+import os
+import logging
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from time import time
+
+
+class TranslationCache(object):
+    """In-memory LRU cache of translations, bounded by the total size of
+    the cached translations and (if ttl is non-zero) by their age in
+    seconds.
+
+    Entries for a pair are dropped when we notice its mode file has
+    changed since they were added.
+
+    If given a SharedTranslationCache, misses are looked up there
+    before giving up, and new translations are added to it too.
+
+    """
+
+    def __init__(self, max_bytes, ttl=0, shared=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.shared = shared
+        self.entries = OrderedDict()  # key: (time added, translation, size), oldest first
+        self.size = 0
+        self.modeMtimes = {}  # pair: mtime of its mode file
+        self.hits = 0
+        self.sharedHits = 0
+        self.misses = 0
+
+    @staticmethod
+    def makeKey(pair, deformat, reformat, nosplit, text):
+        digest = hashlib.sha1(text.encode('utf-8')).digest()
+        return (pair, deformat, reformat, nosplit, digest)
+
+    def checkModeFile(self, pair, mode_path):
+        try:
+            mtime = os.path.getmtime(mode_path)
+        except OSError:
+            mtime = None
+        if self.modeMtimes.setdefault(pair, mtime) != mtime:
+            logging.info("Mode file of %s-%s changed, dropping its cached translations", pair[0], pair[1])
+            for key in [key for key in self.entries if key[0] == pair]:
+                self.remove(key)
+            self.modeMtimes[pair] = mtime
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and self.ttl and time() - entry[0] > self.ttl:
+            self.remove(key)
+            entry = None
+        if entry is None:
+            translation = None
+            if self.shared is not None:
+                translation = self.shared.get(key, self.modeMtimes.get(key[0]))
+            if translation is None:
+                self.misses += 1
+            else:
+                self.sharedHits += 1
+                self.putLocal(key, translation)
+            return translation
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, translation):
+        if self.shared is not None:
+            self.shared.put(key, translation, self.modeMtimes.get(key[0]))
+        self.putLocal(key, translation)
+
+    def putLocal(self, key, translation):
+        size = sizeOf(translation)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (time(), translation, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.size -= size
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'sharedHits': self.sharedHits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'bytes': self.size
+        }
+
+
+class SentenceMemo(object):
+    """What FlushingPipeline.translate needs to look up and store the
+    (deformatted) sentences of one pair in a TranslationCache."""
+
+    def __init__(self, cache, pair):
+        self.cache = cache
+        self.pair = pair
+
+    def key(self, sentence):
+        return (self.pair, hashlib.sha1(sentence).digest())
+
+    def get(self, sentence):
+        return self.cache.get(self.key(sentence))
+
+    def put(self, sentence, translation):
+        self.cache.put(self.key(sentence), translation)
+
+
+def sizeOf(translation):
+    if isinstance(translation, bytes):
+        return len(translation)
+    else:
+        return len(translation.encode('utf-8'))
+
+
+class SharedTranslationCache(object):
+    """Translations cached in an SQLite database in WAL mode, so all the
+    processes started with -j can read and write the same cache, and a
+    translation is only done once per host.
+
+    Entries remember the mtime of the mode file of their pair, and don't
+    count as hits if the mode file has changed since. When the cache
+    grows past max_bytes, the least recently used entries go first,
+    though to save on writes we only note the use of an entry once per
+    USE_RESOLUTION seconds.
+
+    """
+
+    USE_RESOLUTION = 60
+    # We run on the IOLoop, so rather than wait for another process
+    # to finish writing, we count a locked database as a miss:
+    BUSY_TIMEOUT_MS = 5
+
+    def __init__(self, dbPath, max_bytes, ttl=0):
+        self.dbPath = dbPath
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.conn = None
+        self.pid = None
+
+    def connect(self):
+        # Each forked process needs its own connection:
+        if self.conn is None or self.pid != os.getpid():
+            # Setting up is done once, so may wait a bit:
+            conn = sqlite3.connect(self.dbPath, timeout=1, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            # So the triggers also see rows deleted by INSERT OR REPLACE:
+            conn.execute('PRAGMA recursive_triggers = ON')
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('CREATE TABLE IF NOT EXISTS translations (key BLOB PRIMARY KEY, translation TEXT, size INTEGER, '
+                             'mtime REAL, added REAL, used REAL)')
+                conn.execute('CREATE INDEX IF NOT EXISTS translations_used ON translations (used)')
+                # A running total, so we needn't sum up all the sizes to
+                # know when to evict:
+                conn.execute('CREATE TABLE IF NOT EXISTS totalSize (id INTEGER PRIMARY KEY, size INTEGER)')
+                conn.execute('INSERT OR IGNORE INTO totalSize SELECT 0, COALESCE(SUM(size), 0) FROM translations')
+                conn.execute('CREATE TRIGGER IF NOT EXISTS translations_added AFTER INSERT ON translations '
+                             'BEGIN UPDATE totalSize SET size = size + new.size WHERE id = 0; END')
+                conn.execute('CREATE TRIGGER IF NOT EXISTS translations_deleted AFTER DELETE ON translations '
+                             'BEGIN UPDATE totalSize SET size = size - old.size WHERE id = 0; END')
+                conn.execute('COMMIT')
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                conn.close()
+                raise
+            conn.execute('PRAGMA busy_timeout = %d' % self.BUSY_TIMEOUT_MS)
+            self.conn, self.pid = conn, os.getpid()
+        return self.conn
+
+    @staticmethod
+    def isLocked(e):
+        return isinstance(e, sqlite3.OperationalError) and 'locked' in str(e)
+
+    @staticmethod
+    def dbKey(key):
+        return hashlib.sha1(repr(key).encode('utf-8')).digest()
+
+    def get(self, key, mtime):
+        dbKey = self.dbKey(key)
+        now = time()
+        try:
+            conn = self.connect()
+            row = conn.execute('SELECT translation, mtime, added, used FROM translations WHERE key = ?', (dbKey, )).fetchone()
+            if row is None:
+                return None
+            translation, entryMtime, added, used = row
+            if entryMtime != mtime or (self.ttl and now - added > self.ttl):
+                conn.execute('DELETE FROM translations WHERE key = ?', (dbKey, ))
+                return None
+            if now - used > self.USE_RESOLUTION:
+                conn.execute('UPDATE translations SET used = ? WHERE key = ?', (now, dbKey))
+            return translation
+        except sqlite3.Error as e:
+            # The cache shouldn't take translation down with it:
+            if not self.isLocked(e):
+                logging.warning('Shared translation cache lookup failed: %s', e)
+            return None
+
+    def put(self, key, translation, mtime):
+        size = len(translation.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        now = time()
+        try:
+            conn = self.connect()
+            conn.execute('INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?, ?)',
+                         (self.dbKey(key), translation, size, mtime, now, now))
+            self.evict(conn)
+        except sqlite3.Error as e:
+            if not self.isLocked(e):
+                logging.warning('Shared translation cache update failed: %s', e)
+
+    def evict(self, conn):
+        sizeQuery = 'SELECT size FROM totalSize WHERE id = 0'
+        while conn.execute(sizeQuery).fetchone()[0] > self.max_bytes:
+            conn.execute('DELETE FROM translations WHERE key IN '
+                         '(SELECT key FROM translations ORDER BY used LIMIT 100)')
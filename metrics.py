@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 sts=4 et :
+
+"""Counters, gauges and histograms, output in the Prometheus text
+exposition format.
+
+With -j, every forked process keeps its own metrics; each one dumps
+them to a file in a directory shared by all of them (see dump), so
+whichever process gets the /metrics request can add them all up (see
+collect).
+
+"""
+
+import os
+import errno
+import json
+import logging
+from bisect import bisect_left
+
+STAGE_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.values = {}  # labels tuple: value
+
+    def state(self):
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def formatLabels(self, labels, extra=()):
+        pairs = list(zip(self.labelNames, labels)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for name, value in pairs)
+
+    def exposition(self, values):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for labels, value in sorted(values.items()):
+            lines.extend(self.samples(labels, value))
+        return lines
+
+    def samples(self, labels, value):
+        return ['%s%s %s' % (self.name, self.formatLabels(labels), value)]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Gauges from different processes are summed, so they should be
+    things like "pipes running", not "seconds since …"."""
+    kind = 'gauge'
+
+    def set(self, labels=(), value=0):
+        self.values[labels] = value
+
+    def clear(self):
+        self.values.clear()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelNames=(), buckets=STAGE_BUCKETS):
+        super().__init__(name, help, labelNames)
+        self.buckets = buckets
+
+    def observe(self, labels, value):
+        if labels not in self.values:
+            # one count per bucket, then +Inf, then the sum:
+            self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts = self.values[labels]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+    def samples(self, labels, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ['+Inf'], counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (self.name, self.formatLabels(labels, [('le', bound)]), cumulative))
+        lines.append('%s_sum%s %s' % (self.name, self.formatLabels(labels), counts[-1]))
+        lines.append('%s_count%s %d' % (self.name, self.formatLabels(labels), cumulative))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+        # Called before taking a snapshot, e.g. to update gauges:
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def state(self):
+        for collector in self.collectors:
+            collector()
+        return {metric.name: metric.state() for metric in self.metrics}
+
+    def dump(self, metricsDir):
+        """Write our metrics where the other processes can find them."""
+        path = os.path.join(metricsDir, '%d.json' % os.getpid())
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.state(), f)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:  # IOError isn't an OSError before Python 3.3
+            logging.warning('Could not dump metrics to %s: %s', path, e)
+
+    def collect(self, metricsDir=None):
+        """Sum up the metrics of this process and, if metricsDir is
+        given, those dumped there by any other living processes."""
+        states = [self.state()]
+        if metricsDir is not None:
+            for filename in os.listdir(metricsDir):
+                pid, ext = os.path.splitext(filename)
+                if ext != '.json' or not pid.isdigit() or int(pid) == os.getpid() or not pidAlive(int(pid)):
+                    continue
+                try:
+                    with open(os.path.join(metricsDir, filename)) as f:
+                        states.append(json.load(f))
+                except (IOError, OSError, ValueError) as e:
+                    logging.warning('Could not read metrics from %s: %s', filename, e)
+        lines = []
+        for metric in self.metrics:
+            values = {}
+            for state in states:
+                for labels, value in state.get(metric.name, []):
+                    labels = tuple(labels)
+                    values[labels] = metric.merge(values[labels], value) if labels in values else value
+            lines.extend(metric.exposition(values))
+        return '\n'.join(lines) + '\n'
+
+
+def pidAlive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+
+def stageTimer(pair):
+    """Something to give a Pipeline of pair for its stageTimer."""
+    pairName = '%s-%s' % pair
+
+    def noteStage(stage, seconds):
+        stageSeconds.observe((pairName, stage), seconds)
+    return noteStage
+
+
+registry = Registry()
+
+requests = registry.register(Counter(
+    'apertium_apy_requests_total', 'Translation requests handled', ('pair', )))
+stageSeconds = registry.register(Histogram(
+    'apertium_apy_stage_seconds',
+    'Seconds spent on each stage of translating a chunk: queue (waiting for room in the pipeline), '
+    'deformat, pipeline, reformat, and encode (the whole response)',
+    ('pair', 'stage')))
+pipeUsers = registry.register(Gauge(
+    'apertium_apy_pipe_users', 'Requests currently using the pipelines of a pair', ('pair', )))
+pipes = registry.register(Gauge(
+    'apertium_apy_pipes', 'Pipelines currently running for a pair', ('pair', )))
+pipeRss = registry.register(Gauge(
+    'apertium_apy_pipe_rss_bytes', 'Resident memory of the processes of the pipelines of a pair, as last sampled', ('pair', )))
+pipeCpuSeconds = registry.register(Gauge(
+    'apertium_apy_pipe_cpu_seconds', 'CPU seconds used by the processes of the running pipelines of a pair, as last sampled',
+    ('pair', )))
+holdingPipes = registry.register(Gauge(
+    'apertium_apy_holding_pipes', 'Pipelines scheduled for shutdown once their users are done'))
+pipeRestarts = registry.register(Counter(
+    'apertium_apy_pipe_restarts_total', 'Pipelines scheduled for restart after too many requests, RSS or latency growth, or getting stuck', ('pair', )))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 sts=4 et :
+
+"""Memory and CPU use of processes (and their children), from /proc."""
+
+import os
+import logging
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+except (ValueError, OSError, AttributeError):
+    PAGE_SIZE, CLOCK_TICKS = 4096, 100
+
+
+def readStat(pid):
+    """(ppid, RSS in bytes, user+system CPU seconds) of pid, or None if
+    it's gone."""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            stat = f.read()
+    except (IOError, OSError):  # IOError isn't an OSError before Python 3.3
+        return None
+    # The command name may contain spaces, but not a ')':
+    fields = stat[stat.rindex(')') + 2:].split()
+    return (int(fields[1]),
+            int(fields[21]) * PAGE_SIZE,
+            (int(fields[11]) + int(fields[12])) / CLOCK_TICKS)
+
+
+def snapshot():
+    """pid: readStat(pid) of every process we can see."""
+    procs = {}
+    try:
+        pids = [int(name) for name in os.listdir('/proc') if name.isdigit()]
+    except OSError as e:
+        logging.warning('Could not list processes in /proc: %s', e)
+        return procs
+    for pid in pids:
+        stat = readStat(pid)
+        if stat is not None:
+            procs[pid] = stat
+    return procs
+
+
+def treeTotals(procs, pids):
+    """Sum up (RSS, CPU seconds) over pids and all their descendants in
+    a snapshot."""
+    children = {}
+    for pid, (ppid, _, _) in procs.items():
+        children.setdefault(ppid, []).append(pid)
+    rss, cpu = 0, 0.0
+    seen = set()
+    todo = list(pids)
+    while todo:
+        pid = todo.pop()
+        if pid in seen or pid not in procs:
+            continue
+        seen.add(pid)
+        rss += procs[pid][1]
+        cpu += procs[pid][2]
+        todo.extend(children.get(pid, []))
+    return rss, cpu
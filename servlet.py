@@ -14,10 +14,8 @@ import zipfile
 import string
 import random
 from subprocess import Popen, PIPE
-from multiprocessing import Pool, TimeoutError
-from functools import wraps
-from threading import Thread
 from datetime import datetime, timedelta
+from collections import deque
 from urllib.parse import urlparse
 import heapq
 
@@ -27,10 +25,16 @@ import tornado.httpserver
 import tornado.httputil
 import tornado.process
 import tornado.iostream
+import tornado.websocket
 from tornado import httpclient
 from tornado import gen
 from tornado import escape
 from tornado.escape import utf8
+from tornado.concurrent import Future
+try:  # >=4.2
+    import tornado.locks as locks
+except ImportError:
+    import toro as locks
 try:  # 3.1
     from tornado.log import enable_pretty_logging
 except ImportError:  # 2.1
@@ -38,10 +42,16 @@ except ImportError:  # 2.1
 
 from modeSearch import searchPath
 from keys import getKey
-from util import getLocalizedLanguages, stripTags, processPerWord, getCoverage, getCoverages, toAlpha3Code, toAlpha2Code, scaleMtLog, TranslationInfo, removeDotFromDeformat
+from cache import TranslationCache, SharedTranslationCache, SentenceMemo
+from stats import TimingStats
+from autoscale import Autoscaler
+from util import getLocalizedLanguages, stripTags, calcCoverage, toAlpha3Code, toAlpha2Code, scaleMtLog, TranslationInfo, removeDotFromDeformat
 
 import systemd
 import missingdb
+import usecountdb
+import procstat
+import metrics
 
 if sys.version_info.minor < 3:
     import translation_py32 as translation
@@ -64,30 +74,21 @@ except:
 __version__ = "0.9.1"
 
 
-def run_async_thread(func):
-    @wraps(func)
-    def async_func(*args, **kwargs):
-        func_hl = Thread(target=func, args=args, kwargs=kwargs)
-        func_hl.start()
-        return func_hl
-
-    return async_func
-
-
 missingFreqsDb = None       # has to be global for sig_handler :-/
+useCountDb = None
 
 
 def sig_handler(sig, frame):
     global missingFreqsDb
+    if 'children' in frame.f_locals:
+        # Let the children save their stuff too
+        for child in frame.f_locals['children']:
+            os.kill(child, signal.SIGTERM)
     if missingFreqsDb is not None:
-        if 'children' in frame.f_locals:
-            for child in frame.f_locals['children']:
-                os.kill(child, signal.SIGTERM)
-            missingFreqsDb.commit()
-        else:
-            # we are one of the children
-            missingFreqsDb.commit()
+        missingFreqsDb.commit()
         missingFreqsDb.closeDb()
+    if useCountDb is not None:
+        useCountDb.closeDb()
     logging.warning('Caught signal: %s', sig)
     exit()
 
@@ -97,7 +98,7 @@ class BaseHandler(tornado.web.RequestHandler):
     analyzers = {}
     generators = {}
     taggers = {}
-    pipelines = {}  # (l1, l2): [translation.Pipeline], only contains flushing pairs!
+    pipelines = {}  # (l1, l2) or (mode type, lang): [translation.Pipeline], only contains flushing pairs!
     pipelines_holding = []
     callback = None
     timeout = None
@@ -108,7 +109,7 @@ class BaseHandler(tornado.web.RequestHandler):
         'startdate': datetime.now(),
         'useCount': {},
         'vmsize': 0,
-        'timing': []
+        'timing': TimingStats()
     }
 
     pipeline_cmds = {}  # (l1, l2): translation.ParsedModes
@@ -116,7 +117,23 @@ class BaseHandler(tornado.web.RequestHandler):
     min_pipes_per_pair = 0
     max_users_per_pipe = 5
     max_idle_secs = 0
-    restart_pipe_after = 1000
+    restart_pipe_after = 0
+    restart_rss_growth = 2.0  # restart pipes that grow to this many times their warmed-up RSS
+    restart_latency_growth = 0  # restart pipes this many times slower per byte than their best
+    short_request_chars = 1000  # up to this many chars get high priority by default
+    max_batch_segments = 1000  # per /translateBatch request
+    max_batch_chars = 100000
+    coverage_semaphore = locks.Semaphore(4)  # see --coverage-concurrency
+    # Budget for all the pipelines of all pairs; 0 means no limit:
+    total_max_pipes = 0
+    total_max_rss = 0  # bytes
+    pairRss = {}  # (l1, l2): RSS of the biggest pipeline of the pair last we looked
+    batch_window_ms = 0
+    batch_max_bytes = 4096
+    translation_cache = None  # TranslationCache, if enabled
+    sentence_cache = None  # TranslationCache of deformatted sentences, if enabled
+    metrics_dir = None  # where forked processes share their metrics
+    autoscaler = Autoscaler()
 
     def initialize(self):
         self.callback = self.get_argument('callback', default=None)
@@ -226,22 +243,9 @@ class StatsHandler(BaseHandler):
 
     @tornado.web.asynchronous
     def get(self):
-        numRequests = self.get_argument('requests', 1000)
-        try:
-            numRequests = int(numRequests)
-        except ValueError:
-            numRequests = 1000
-
-        periodStats = self.stats['timing'][-numRequests:]
-        times = sum([x[1] - x[0] for x in periodStats],
-                    timedelta())
-        chars = sum(x[2] for x in periodStats)
-        if times.total_seconds() != 0:
-            charsPerSec = round(chars / times.total_seconds(), 2)
-        else:
-            charsPerSec = 0.0
-        nrequests = len(periodStats)
-        maxAge = (datetime.now() - periodStats[0][0]).total_seconds() if periodStats else 0
+        timing = self.stats['timing']
+        now = time.time()
+        periodStats = timing.window(timing.maxAge, now=now).toJson(now)
 
         uptime = int((datetime.now() - self.stats['startdate']).total_seconds())
         useCount = {'%s-%s' % pair: useCount
@@ -251,24 +255,66 @@ class StatsHandler(BaseHandler):
                         if pipes != []}
         holdingPipes = len(self.pipelines_holding)
 
+        responseData = {
+            'uptime': uptime,
+            'useCount': useCount,
+            'runningPipes': runningPipes,
+            'holdingPipes': holdingPipes,
+            'periodStats': periodStats,
+            'windowStats': timing.toJson(now),
+            'pipeLoad': self.autoscaler.toJson(now),
+            'pipeResources': self.pipeResources()
+        }
+        if self.translation_cache is not None:
+            responseData['cache'] = self.translation_cache.stats()
+        if self.sentence_cache is not None:
+            responseData['sentenceCache'] = self.sentence_cache.stats()
+
         self.sendResponse({
-            'responseData': {
-                'uptime': uptime,
-                'useCount': useCount,
-                'runningPipes': runningPipes,
-                'holdingPipes': holdingPipes,
-                'periodStats': {
-                    'charsPerSec': charsPerSec,
-                    'totChars': chars,
-                    'totTimeSpent': times.total_seconds(),
-                    'requests': nrequests,
-                    'ageFirstRequest': maxAge
-                }
-            },
+            'responseData': responseData,
             'responseDetails': None,
             'responseStatus': 200
         })
 
+    def pipeResources(self):
+        resources = {}
+        for pair, pipes in self.pipelines.items():
+            sampled = [pipe for pipe in pipes if pipe.sampledAt is not None]
+            if sampled:
+                resources['%s-%s' % pair] = {
+                    'pipes': len(sampled),
+                    'rss': sum(pipe.rss for pipe in sampled),
+                    'maxRss': max(pipe.rss for pipe in sampled),
+                    'cpuSeconds': round(sum(pipe.cpuSeconds for pipe in sampled), 2),
+                    'cpuPercent': round(sum(pipe.cpuPercent for pipe in sampled), 1)
+                }
+        return resources
+
+
+class MetricsHandler(BaseHandler):
+
+    @tornado.web.asynchronous
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=UTF-8')
+        self._write_buffer.append(utf8(metrics.registry.collect(self.metrics_dir)))
+        self.finish()
+
+
+def collectPipeMetrics():
+    metrics.pipeUsers.clear()
+    metrics.pipes.clear()
+    metrics.pipeRss.clear()
+    metrics.pipeCpuSeconds.clear()
+    for pair, pipes in BaseHandler.pipelines.items():
+        metrics.pipeUsers.set(('%s-%s' % pair, ), sum(p.users for p in pipes))
+        metrics.pipes.set(('%s-%s' % pair, ), len(pipes))
+        metrics.pipeRss.set(('%s-%s' % pair, ), sum(p.rss for p in pipes))
+        metrics.pipeCpuSeconds.set(('%s-%s' % pair, ), sum(p.cpuSeconds for p in pipes))
+    metrics.holdingPipes.set((), len(BaseHandler.pipelines_holding))
+
+
+metrics.registry.collectors.append(collectPipeMetrics)
+
 
 class RootHandler(BaseHandler):
 
@@ -281,6 +327,8 @@ class TranslateHandler(BaseHandler):
 
     def notePairUsage(self, pair):
         self.stats['useCount'][pair] = 1 + self.stats['useCount'].get(pair, 0)
+        if useCountDb is not None:
+            useCountDb.noteUse('%s-%s' % pair)
 
     unknownMarkRE = re.compile(r'[*]([^.,;:\t\* ]+)')
 
@@ -297,42 +345,118 @@ class TranslateHandler(BaseHandler):
             for token in re.findall(self.unknownMarkRE, text):
                 missingFreqsDb.noteUnknown(token, pair)
 
+    def recycleReason(self, pipe):
+        if self.restart_pipe_after and pipe.useCount > self.restart_pipe_after:
+            return 'it has handled %d requests' % pipe.useCount
+        elif (self.restart_rss_growth and pipe.baseRss and
+                pipe.rss > self.restart_rss_growth * pipe.baseRss):
+            return 'its RSS grew from %d to %d bytes' % (pipe.baseRss, pipe.rss)
+        elif (self.restart_latency_growth and pipe.baseSecsPerByte and
+                pipe.secsPerByte > self.restart_latency_growth * pipe.baseSecsPerByte):
+            return 'it slowed down from %.2g to %.2g secs per byte' % (pipe.baseSecsPerByte, pipe.secsPerByte)
+        else:
+            return None
+
+    @classmethod
+    @gen.coroutine
+    def recyclePipeline(cls, pair, old):
+        """Start and check a replacement for old before letting it
+        finish its requests in pipelines_holding."""
+        old.recycling = True
+        try:
+            replacement = cls.newPipeline(pair)
+            ok = yield cls.testPipeline(pair, replacement)
+        except Exception as e:
+            logging.warning('Could not start a replacement pipeline for %s-%s: %r', pair[0], pair[1], e)
+            ok = False
+        if not ok:
+            # Keep the old one going, and try again later
+            old.recycling = False
+            return
+        pipes = cls.pipelines.get(pair, [])
+        if old not in pipes:
+            # It was dropped (stuck, evicted or idle) while we were
+            # testing, so the pair has no room for the replacement
+            logging.info('A pipe for %s-%s went away before its replacement was up, dropping that too', pair[0], pair[1])
+            return
+        pipes.remove(old)
+        cls.pipelines_holding.append(old)
+        heapq.heappush(pipes, replacement)
+        heapq.heapify(pipes)
+
     def cleanable(self, i, pair, pipe):
-        if pipe.useCount > self.restart_pipe_after:
-            # Not affected by min_pipes_per_pair
-            logging.info('A pipe for pair %s-%s has handled %d requests, scheduling restart',
-                         pair[0], pair[1], self.restart_pipe_after)
-            return True
-        elif (i >= self.min_pipes_per_pair and
+        if (i >= self.min_pipes_per_pair and
                 self.max_idle_secs != 0 and
                 time.time() - pipe.lastUsage > self.max_idle_secs):
             logging.info("A pipe for pair %s-%s hasn't been used in %d secs, scheduling shutdown",
                          pair[0], pair[1], self.max_idle_secs)
             return True
+        elif (i >= max(1, self.autoscaler.wanted(pair, len(self.pipelines[pair]))) and
+                pipe.users == 0 and
+                time.time() - pipe.lastUsage > self.autoscaler.COOLDOWN):
+            # Going down to no pipes at all is left to max_idle_secs
+            logging.info("Pair %s-%s needs fewer pipes, scheduling shutdown of an idle one",
+                         pair[0], pair[1])
+            return True
         else:
             return False
 
     def cleanPairs(self):
         for pair in self.pipelines:
             pipes = self.pipelines[pair]
+            for pipe in pipes:
+                reason = None if pipe.recycling else self.recycleReason(pipe)
+                if reason is not None:
+                    # Not affected by min_pipes_per_pair
+                    logging.info('A pipe for pair %s-%s needs a restart since %s, starting its replacement',
+                                 pair[0], pair[1], reason)
+                    metrics.pipeRestarts.inc(('%s-%s' % pair, ))
+                    self.recyclePipeline(pair, pipe)
             to_clean = set(p for i, p in enumerate(pipes)
                            if self.cleanable(i, pair, p))
             self.pipelines_holding += to_clean
             pipes[:] = [p for p in pipes if p not in to_clean]
             heapq.heapify(pipes)
-        # The holding area lets us restart pipes after n usages next
-        # time round, since with lots of traffic an active pipe may
-        # never reach 0 users
+        # The holding area lets us restart pipes once their
+        # replacements are up, since with lots of traffic an active
+        # pipe may never reach 0 users
         self.pipelines_holding[:] = [p for p in self.pipelines_holding
                                      if p.users > 0]
         if self.pipelines_holding:
             logging.info("%d pipelines still scheduled for shutdown", len(self.pipelines_holding))
 
-    def getPipeCmds(self, l1, l2):
-        if (l1, l2) not in self.pipeline_cmds:
-            mode_path = self.pairs['%s-%s' % (l1, l2)]
-            self.pipeline_cmds[(l1, l2)] = translation.parseModeFile(mode_path)
-        return self.pipeline_cmds[(l1, l2)]
+    @classmethod
+    def replaceIfStuck(cls, pair, pipeline):
+        pipes = cls.pipelines.get(pair, [])
+        if pipeline.stuck and pipeline in pipes:
+            logging.warning("Replacing stuck pipeline for %s-%s", pair[0], pair[1])
+            metrics.pipeRestarts.inc(('%s-%s' % pair, ))
+            pipes.remove(pipeline)
+            heapq.heapify(pipes)
+            cls.startPipeline(pair)
+
+    @classmethod
+    def getPipeCmds(cls, l1, l2):
+        if (l1, l2) not in cls.pipeline_cmds:
+            if l1 in ['analyzer', 'generator', 'tagger']:
+                # These are keyed by (mode type, lang)
+                path, mode = {'analyzer': cls.analyzers, 'generator': cls.generators, 'tagger': cls.taggers}[l1][l2]
+                mode_path = os.path.join(path, 'modes', mode + '.mode')
+            elif l1 == 'disambiguator':
+                # What the tagger of l2 runs after its analyzer, see sharesAnalysis
+                analyzer, tagger = cls.getPipeCmds('analyzer', l2), cls.getPipeCmds('tagger', l2)
+                cls.pipeline_cmds[(l1, l2)] = translation.ParsedModes(tagger.do_flush, tagger.commands[len(analyzer.commands):])
+                return cls.pipeline_cmds[(l1, l2)]
+            elif l1 == 'biltrans':
+                # Bilingual lookup of analyses, for /perWord
+                path = (cls.analyzers.get(l2) or cls.taggers[l2])[0]
+                cls.pipeline_cmds[(l1, l2)] = translation.ParsedModes(
+                    True, [['lt-proc', '-b', '-z', os.path.join(path, l2 + '.autobil.bin')]])
+                return cls.pipeline_cmds[(l1, l2)]
+            else:
+                mode_path = cls.pairs['%s-%s' % (l1, l2)]
+            cls.pipeline_cmds[(l1, l2)] = translation.parseModeFile(mode_path)
+        return cls.pipeline_cmds[(l1, l2)]
 
     def shouldStartPipe(self, l1, l2):
         pipes = self.pipelines.get((l1, l2), [])
@@ -341,40 +465,189 @@ class TranslateHandler(BaseHandler):
                          l1, l2)
             return True
         else:
-            min_p = pipes[0]
-            if len(pipes) < self.max_pipes_per_pair and min_p.users > self.max_users_per_pipe:
-                logging.info("%s-%s has ≥%d users per pipe but only %d pipes",
-                             l1, l2, min_p.users, len(pipes))
+            wanted = self.autoscaler.wanted((l1, l2), len(pipes), pipes[0].users)
+            if len(pipes) < wanted:
+                logging.info("%s-%s wants %d pipes but only has %d (%d users on the least busy)",
+                             l1, l2, wanted, len(pipes), pipes[0].users)
                 return True
             else:
                 return False
 
+    @classmethod
+    def checkPipelines(cls):
+        """Kill and replace pipelines that have stopped putting out
+        anything; run periodically, so a wedged pipeline goes even if no
+        later request happens to time out on it."""
+        for pair, pipes in list(cls.pipelines.items()):
+            for pipe in list(pipes):
+                pipe.checkStuck()
+                cls.replaceIfStuck(pair, pipe)
+        for pipe in cls.pipelines_holding:
+            pipe.checkStuck()
+
+    @classmethod
+    def samplePipelines(cls):
+        """Update the RSS and CPU use of all pipelines; run periodically."""
+        procs = procstat.snapshot()
+        now = time.time()
+        for pair, pipes in cls.pipelines.items():
+            for pipe in pipes:
+                pipe.sampleUsage(procs, now)
+            if pipes:
+                cls.pairRss[pair] = max(pipe.rss for pipe in pipes)
+        for pipe in cls.pipelines_holding:
+            pipe.sampleUsage(procs, now)
+
+    @classmethod
+    def makeRoom(cls, pair):
+        """Shut down least recently used idle pipelines of other pairs
+        until there's room in the budget for another one of pair.
+        Returns False if there's no more to shut down and we're still
+        over budget."""
+        if not cls.total_max_pipes and not cls.total_max_rss:
+            return True
+        procs = procstat.snapshot() if cls.total_max_rss else {}
+        rss = {}
+        for other, pipes in cls.pipelines.items():
+            for pipe in pipes:
+                rss[pipe] = procstat.treeTotals(procs, pipe.pids())[0]
+            if pipes and procs:
+                cls.pairRss[other] = max(rss[pipe] for pipe in pipes)
+        count = sum(len(pipes) for pipes in cls.pipelines.values()) + len(cls.pipelines_holding)
+        totalRss = sum(rss.values()) + sum(procstat.treeTotals(procs, pipe.pids())[0]
+                                           for pipe in cls.pipelines_holding)
+        neededRss = cls.pairRss.get(pair, 0)
+        idle = sorted(((other, pipe) for other, pipes in cls.pipelines.items() if other != pair
+                       for pipe in pipes if pipe.users == 0),
+                      key=lambda otherPipe: otherPipe[1].lastUsage)
+        while ((cls.total_max_pipes and count + 1 > cls.total_max_pipes) or
+               (cls.total_max_rss and totalRss + neededRss > cls.total_max_rss)):
+            if not idle:
+                logging.warning("Pipelines are over budget (%d pipes, %d bytes RSS), but none are idle", count, totalRss)
+                return False
+            other, pipe = idle.pop(0)
+            logging.info("Shutting down an idle pipeline for %s-%s to make room for %s-%s",
+                         other[0], other[1], pair[0], pair[1])
+            cls.pipelines[other].remove(pipe)
+            heapq.heapify(cls.pipelines[other])
+            count -= 1
+            totalRss -= rss[pipe]
+        return True
+
+    @classmethod
+    def startPipeline(cls, pair):
+        """Start another pipeline for pair, unless it already has one
+        and there's no room in the budget; returns the new pipeline or
+        None."""
+        if not cls.makeRoom(pair) and cls.pipelines.get(pair):
+            return None
+        if pair not in cls.pipelines:
+            cls.pipelines[pair] = []
+        p = cls.newPipeline(pair)
+        heapq.heappush(cls.pipelines[pair], p)
+        return p
+
+    @classmethod
+    def newPipeline(cls, pair):
+        logging.info("Starting up a new pipeline for %s-%s …", pair[0], pair[1])
+        timer = metrics.stageTimer(pair)
+
+        def noteStage(stage, seconds):
+            timer(stage, seconds)
+            cls.autoscaler.noteStage(pair, stage, seconds)
+        return translation.makePipeline(cls.getPipeCmds(pair[0], pair[1]), timeout=cls.timeout,
+                                        batch_window_ms=cls.batch_window_ms,
+                                        batch_max_bytes=cls.batch_max_bytes,
+                                        stageTimer=noteStage)
+
+    @classmethod
+    def scalePipelines(cls):
+        """Start the pipelines the autoscaler wants before requests
+        have to wait for them; run periodically."""
+        for pair, pipes in list(cls.pipelines.items()):
+            # Pairs without pipes get their first one on their next request
+            if pipes and len(pipes) < cls.autoscaler.wanted(pair, len(pipes), pipes[0].users):
+                logging.info("Traffic for %s-%s is picking up, pre-warming a pipeline", pair[0], pair[1])
+                cls.startPipeline(pair)
+
+    PREWARM_SENTENCE = 'This is a test.'
+    PREWARM_TIMEOUT = 300  # seconds; the biggest pairs can take a while to load
+
+    @classmethod
+    @gen.coroutine
+    def prewarmPipelines(cls, pair):
+        """Start min_pipes_per_pair (at least one) pipelines for pair,
+        and check each by translating a test sentence, so the first
+        requests don't have to wait for the transducers to load."""
+        pipes = cls.pipelines.get(pair, [])
+        for _ in range(max(1, cls.min_pipes_per_pair) - len(pipes)):
+            pipeline = cls.startPipeline(pair)
+            if pipeline is None:
+                break
+            ok = yield cls.testPipeline(pair, pipeline)
+            if not ok:
+                cls.pipelines[pair].remove(pipeline)
+                heapq.heapify(cls.pipelines[pair])
+
+    @classmethod
+    @gen.coroutine
+    def testPipeline(cls, pair, pipeline):
+        """Translate a test sentence, which also gets the transducers
+        loaded; returns whether it worked."""
+        try:
+            yield translation.withTimeout(cls.PREWARM_TIMEOUT,
+                                          pipeline.translate(cls.PREWARM_SENTENCE, nosplit=True))
+        except Exception as e:
+            logging.warning('New pipeline for %s-%s failed its test translation, shutting it down: %r',
+                            pair[0], pair[1], e)
+            raise gen.Return(False)
+        raise gen.Return(True)
+
     def getPipeline(self, pair):
         (l1, l2) = pair
         if self.shouldStartPipe(l1, l2):
-            logging.info("Starting up a new pipeline for %s-%s …", l1, l2)
-            if pair not in self.pipelines:
-                self.pipelines[pair] = []
-            p = translation.makePipeline(self.getPipeCmds(l1, l2))
-            heapq.heappush(self.pipelines[pair], p)
+            self.startPipeline(pair)
         return self.pipelines[pair][0]
 
+    @gen.coroutine
+    def runMode(self, key, text, deformat, reformat, deadline=None, cancel=None):
+        """Run text through the pipelines of key, a (mode type, lang),
+        which are started, scaled and shut down like those of pairs.
+        Raises gen.TimeoutError or StreamClosedError if the pipeline
+        fails."""
+        pipeline = self.getPipeline(key)
+        try:
+            result = yield pipeline.translate(text, nosplit=True, deformat=deformat, reformat=reformat, deadline=deadline,
+                                              cancel=cancel)
+        except (gen.TimeoutError, tornado.iostream.StreamClosedError):
+            self.replaceIfStuck(key, pipeline)
+            raise
+        finally:
+            self.cleanPairs()
+        raise gen.Return(result)
+
+    def sendModeError(self, e):
+        """send_error for an exception raised by runMode."""
+        if isinstance(e, gen.TimeoutError):
+            self.send_error(408, explanation='Request timed out')
+        else:
+            self.send_error(503, explanation='Pipeline failed, please try again')
+
     def logBeforeTranslation(self):
         return datetime.now()
 
-    def logAfterTranslation(self, before, length):
+    def translationInfo(self, pair):
+        return TranslationInfo(self)
+
+    def logAfterTranslation(self, before, length, pair=None):
         after = datetime.now()
         if self.scaleMtLogs:
-            tInfo = TranslationInfo(self)
+            tInfo = self.translationInfo(pair)
             key = getKey(tInfo.key)
             scaleMtLog(self.get_status(), after - before, tInfo, key, length)
 
-        if self.get_status() == 200:
-            oldest = self.stats['timing'][0][0] if self.stats['timing'] else datetime.now()
-            if datetime.now() - oldest > self.STAT_PERIOD_MAX_AGE:
-                self.stats['timing'].pop(0)
-            self.stats['timing'].append(
-                (before, after, length))
+        if self.get_status() == 200 and pair is not None:
+            self.stats['timing'].add(pair, length, (after - before).total_seconds())
 
     def getPairOrError(self, langpair, text_length):
         try:
@@ -407,13 +680,59 @@ class TranslateHandler(BaseHandler):
 
         return deformat, reformat
 
+    def getPriority(self, length, default=None):
+        """The priority argument if given (high needs a known API key),
+        else default, else high for short requests and normal for the
+        rest."""
+        priority = self.get_argument('priority', default=None)
+        if priority == 'high' and getKey(self.get_argument('key', default='null')) == 'null':
+            priority = None
+        if priority not in translation.PRIORITIES:
+            priority = default
+        if priority is None:
+            priority = 'high' if length <= self.short_request_chars else 'normal'
+        return translation.PRIORITIES[priority]
+
     @gen.coroutine
-    def translateAndRespond(self, pair, pipeline, toTranslate, markUnknown, nosplit=False, deformat=True, reformat=True):
+    def translateAndRespond(self, pair, pipeline, toTranslate, markUnknown, nosplit=False, deformat=True, reformat=True,
+                            priority=None):
         markUnknown = markUnknown in ['yes', 'true', '1']
         self.notePairUsage(pair)
         before = self.logBeforeTranslation()
-        translated = yield pipeline.translate(toTranslate, nosplit, deformat, reformat)
-        self.logAfterTranslation(before, len(toTranslate))
+        deadline = time.time() + self.timeout if self.timeout else None
+        translated = None
+        cache = self.translation_cache
+        if cache is not None:
+            cache.checkModeFile(pair, self.pairs['%s-%s' % pair])
+            # Unknown-word marks are stripped after lookup, so the key
+            # doesn't need markUnknown:
+            cacheKey = cache.makeKey(pair, deformat, reformat, nosplit, toTranslate)
+            translated = cache.get(cacheKey)
+        memo = None
+        if self.sentence_cache is not None:
+            self.sentence_cache.checkModeFile(pair, self.pairs['%s-%s' % pair])
+            memo = SentenceMemo(self.sentence_cache, pair)
+        if translated is None:
+            try:
+                translated = yield pipeline.translate(toTranslate, nosplit, deformat, reformat, memo=memo, deadline=deadline,
+                                                      priority=self.getPriority(len(toTranslate), priority))
+            except gen.TimeoutError:
+                self.replaceIfStuck(pair, pipeline)
+                self.send_error(408, explanation='Request timed out')
+                self.logAfterTranslation(before, len(toTranslate), pair)
+                return
+            except tornado.iostream.StreamClosedError:
+                if not pipeline.stuck:
+                    raise
+                # Someone else's request found the pipeline stuck and killed it
+                self.replaceIfStuck(pair, pipeline)
+                self.send_error(503, explanation='Pipeline failed, please try again')
+                return
+            if cache is not None:
+                cache.put(cacheKey, translated)
+        self.logAfterTranslation(before, len(toTranslate), pair)
+        metrics.requests.inc(('%s-%s' % pair, ))
+        started = time.time()
         self.sendResponse({
             'responseData': {
                 'translatedText': self.maybeStripMarks(markUnknown, pair, translated)
@@ -421,13 +740,68 @@ class TranslateHandler(BaseHandler):
             'responseDetails': None,
             'responseStatus': 200
         })
+        metrics.stageSeconds.observe(('%s-%s' % pair, 'encode'), time.time() - started)
+        self.cleanPairs()
+
+    STREAM_WINDOW = 8  # chunks of a streamed request in flight at once
+
+    @gen.coroutine
+    def translateAndStream(self, pair, pipeline, toTranslate, markUnknown, deformat=True, reformat=True):
+        """Like translateAndRespond, but send each chunk as a line of
+        JSON as soon as it and those before it are translated, ending
+        with a line giving the responseStatus."""
+        markUnknown = markUnknown in ['yes', 'true', '1']
+        self.notePairUsage(pair)
+        before = self.logBeforeTranslation()
+        deadline = time.time() + self.timeout if self.timeout else None
+        priority = self.getPriority(len(toTranslate))
+        self.set_header('Content-Type', 'application/x-ndjson; charset=UTF-8')
+        parts = deque(translation.splitForTranslation(toTranslate, n_users=pipeline.users))
+        pending = deque()
+        status, details = 200, None
+        try:
+            while parts or pending:
+                while parts and len(pending) < self.STREAM_WINDOW:
+                    pending.append(pipeline.translate(parts.popleft(), nosplit=True, deformat=deformat, reformat=reformat,
+                                                      deadline=deadline, priority=priority))
+                translated = yield pending.popleft()
+                self.write(escape.json_encode({'translatedText': self.maybeStripMarks(markUnknown, pair, translated)}) + '\n')
+                yield self.flush()
+        except gen.TimeoutError:
+            self.replaceIfStuck(pair, pipeline)
+            status, details = 408, 'Request timed out'
+        except tornado.iostream.StreamClosedError:
+            if self.request.connection.stream.closed():
+                logging.info('Client went away while streaming a translation')
+                status = None
+            elif pipeline.stuck:
+                self.replaceIfStuck(pair, pipeline)
+                status, details = 503, 'Pipeline failed, please try again'
+            else:
+                raise
+        finally:
+            for future in pending:
+                # Nobody's waiting for these any more:
+                future.add_done_callback(lambda future: future.exception())
+        if status is not None:
+            self.write(escape.json_encode({'responseDetails': details, 'responseStatus': status}) + '\n')
+            self.finish()
+        self.logAfterTranslation(before, len(toTranslate), pair if status == 200 else None)
+        if status == 200:
+            metrics.requests.inc(('%s-%s' % pair, ))
         self.cleanPairs()
 
     @gen.coroutine
     def get(self):
         pair = self.getPairOrError(self.get_argument('langpair'),
                                    len(self.get_argument('q')))
-        if pair is not None:
+        if pair is not None and self.get_argument('stream', default='no') in ['yes', 'true', '1']:
+            yield self.translateAndStream(pair,
+                                          self.getPipeline(pair),
+                                          self.get_argument('q'),
+                                          self.get_argument('markUnknown', default='yes'),
+                                          *self.getFormat())
+        elif pair is not None:
             pipeline = self.getPipeline(pair)
             deformat, reformat = self.getFormat()
             yield self.translateAndRespond(pair,
@@ -472,7 +846,8 @@ class TranslatePageHandler(TranslateHandler):
                                            self.get_argument('markUnknown', default='yes'),
                                            nosplit=True,
                                            deformat='apertium-deshtml',
-                                           reformat='apertium-rehtml')
+                                           reformat='apertium-rehtml',
+                                           priority='low')
 
 
 class TranslateDocHandler(TranslateHandler):
@@ -591,7 +966,222 @@ class TranslateRawHandler(TranslateHandler):
                                            reformat=False)
 
 
-class AnalyzeHandler(BaseHandler):
+class TranslateBatchHandler(TranslateHandler):
+    """POST a JSON array of segments, each either a string in the pair
+    given by the langpair argument, or {"q": ..., "langpair": ...}.
+    Segments are grouped by pair and written to the pipeline several at
+    a time; the response has a result per segment, in the same order,
+    each with its own responseStatus."""
+
+    def parsePair(self, langpair):
+        try:
+            l1, l2 = map(toAlpha3Code, langpair.split('|'))
+        except ValueError:
+            return None
+        if '%s-%s' % (l1, l2) in self.pairs:
+            return (l1, l2)
+
+    def get(self):
+        raise tornado.web.HTTPError(405)
+
+    def translationInfo(self, pair):
+        # The langpair argument is optional here, so we log per pair
+        return TranslationInfo(self, '%s|%s' % pair)
+
+    @gen.coroutine
+    def post(self):
+        try:
+            segments = escape.json_decode(self.get_argument('q', default=None) or self.request.body)
+        except ValueError:
+            segments = None
+        if not isinstance(segments, list):
+            self.send_error(400, explanation='Send a JSON array of segments')
+            return
+        if len(segments) > self.max_batch_segments:
+            self.send_error(413, explanation='At most %d segments per batch' % self.max_batch_segments)
+            return
+
+        defaultPair = self.get_argument('langpair', default=None)
+        results = [None] * len(segments)
+        byPair = {}  # (l1, l2): [(index, text)]
+        chars = 0
+        for i, segment in enumerate(segments):
+            if isinstance(segment, dict):
+                text, langpair = segment.get('q'), segment.get('langpair', defaultPair)
+            else:
+                text, langpair = segment, defaultPair
+            if not isinstance(text, str) or not isinstance(langpair, str):
+                results[i] = {'responseDetails': 'Segments need a q and a langpair', 'responseStatus': 400}
+                continue
+            pair = self.parsePair(langpair)
+            if pair is None:
+                results[i] = {'responseDetails': 'That pair is invalid or not installed', 'responseStatus': 400}
+                continue
+            chars += len(text)
+            byPair.setdefault(pair, []).append((i, text))
+        if chars > self.max_batch_chars:
+            self.send_error(413, explanation='At most %d characters per batch' % self.max_batch_chars)
+            return
+
+        deformat, reformat = self.getFormat()
+        markUnknown = self.get_argument('markUnknown', default='yes') in ['yes', 'true', '1']
+        deadline = time.time() + self.timeout if self.timeout else None
+        priority = self.getPriority(chars, 'normal')
+        yield [self.translatePairSegments(pair, pairSegments, results, deformat, reformat, markUnknown, deadline, priority)
+               for pair, pairSegments in byPair.items()]
+        self.sendResponse({
+            'responseData': results,
+            'responseDetails': None,
+            'responseStatus': 200
+        })
+        self.cleanPairs()
+
+    @gen.coroutine
+    def translatePairSegments(self, pair, segments, results, deformat, reformat, markUnknown, deadline, priority):
+        """Put the results of translating segments, a list of (index,
+        text) in pair, into results."""
+        self.notePairUsage(pair)
+        before = self.logBeforeTranslation()
+        cache = self.translation_cache
+        if cache is not None:
+            cache.checkModeFile(pair, self.pairs['%s-%s' % pair])
+        todo = []
+        for i, text in segments:
+            cacheKey = translated = None
+            if cache is not None:
+                cacheKey = cache.makeKey(pair, deformat, reformat, False, text)
+                translated = cache.get(cacheKey)
+            if translated is None:
+                todo.append((i, cacheKey, text))
+            else:
+                results[i] = {'translatedText': self.maybeStripMarks(markUnknown, pair, translated), 'responseStatus': 200}
+        if todo:
+            pipeline = self.getPipeline(pair)
+            futures = pipeline.translateMany([text for _, _, text in todo], deformat, reformat, deadline, priority)
+            for (i, cacheKey, text), future in zip(todo, futures):
+                try:
+                    translated = yield future
+                except gen.TimeoutError:
+                    self.replaceIfStuck(pair, pipeline)
+                    results[i] = {'responseDetails': 'Request timed out', 'responseStatus': 408}
+                    continue
+                except tornado.iostream.StreamClosedError:
+                    if not pipeline.stuck:
+                        raise
+                    self.replaceIfStuck(pair, pipeline)
+                    results[i] = {'responseDetails': 'Pipeline failed, please try again', 'responseStatus': 503}
+                    continue
+                if cache is not None:
+                    cache.put(cacheKey, translated)
+                results[i] = {'translatedText': self.maybeStripMarks(markUnknown, pair, translated), 'responseStatus': 200}
+        self.logAfterTranslation(before, sum(len(text) for _, text in segments), pair)
+        metrics.requests.inc(('%s-%s' % pair, ))
+
+
+class TranslateSocketHandler(tornado.websocket.WebSocketHandler, TranslateHandler):
+    """A session bound to the langpair (and format) given when
+    connecting. Clients send segments as {"id": ..., "q": ...} and get
+    {"id": ..., "translatedText": ..., "responseStatus": 200} back in
+    whatever order they finish. Sending a segment with the id of one
+    still in flight, or {"id": ..., "cancel": true}, drops the old one
+    without a reply."""
+
+    def check_origin(self, origin):
+        return True
+
+    @gen.coroutine
+    def get(self, *args, **kwargs):
+        self.pair = self.getPairOrError(self.get_argument('langpair', default=''), 0)
+        if self.pair is not None:
+            self.deformat, self.reformat = self.getFormat()
+            self.markUnknown = self.get_argument('markUnknown', default='yes') in ['yes', 'true', '1']
+            self.inflight = {}  # segment id: Future to set to cancel it
+            result = tornado.websocket.WebSocketHandler.get(self, *args, **kwargs)
+            if result is not None:
+                yield result
+
+    def reply(self, data):
+        if self.ws_connection is not None:
+            self.write_message(escape.json_encode(data))
+
+    def cancelSegment(self, segmentId):
+        cancel = self.inflight.pop(segmentId, None)
+        if cancel is not None:
+            cancel.set_result(None)
+
+    def on_message(self, message):
+        try:
+            segment = escape.json_decode(message)
+            segmentId = segment['id']
+            hash(segmentId)
+        except (ValueError, TypeError, KeyError):
+            self.reply({'id': None, 'responseDetails': 'Send JSON objects with an id and q', 'responseStatus': 400})
+            return
+        self.cancelSegment(segmentId)
+        if segment.get('cancel'):
+            return
+        toTranslate = segment.get('q')
+        if not isinstance(toTranslate, str):
+            self.reply({'id': segmentId, 'responseDetails': 'Missing q', 'responseStatus': 400})
+            return
+        cancel = Future()
+        self.inflight[segmentId] = cancel
+        tornado.ioloop.IOLoop.current().add_future(self.translateSegment(segmentId, toTranslate, cancel),
+                                                   lambda future: future.result())
+
+    @gen.coroutine
+    def translateSegment(self, segmentId, toTranslate, cancel):
+        pair = self.pair
+        self.notePairUsage(pair)
+        started = time.time()
+        deadline = started + self.timeout if self.timeout else None
+        pipeline = self.getPipeline(pair)
+        status, details, translated = 200, None, None
+        cache = self.translation_cache
+        if cache is not None:
+            cache.checkModeFile(pair, self.pairs['%s-%s' % pair])
+            cacheKey = cache.makeKey(pair, self.deformat, self.reformat, False, toTranslate)
+            translated = cache.get(cacheKey)
+        memo = None
+        if self.sentence_cache is not None:
+            self.sentence_cache.checkModeFile(pair, self.pairs['%s-%s' % pair])
+            memo = SentenceMemo(self.sentence_cache, pair)
+        try:
+            if translated is None:
+                translated = yield pipeline.translate(toTranslate, False, self.deformat, self.reformat, memo=memo,
+                                                      deadline=deadline, priority=self.getPriority(len(toTranslate)),
+                                                      cancel=cancel)
+                if cache is not None:
+                    cache.put(cacheKey, translated)
+        except translation.Cancelled:
+            return
+        except gen.TimeoutError:
+            self.replaceIfStuck(pair, pipeline)
+            status, details = 408, 'Request timed out'
+        except tornado.iostream.StreamClosedError:
+            if not pipeline.stuck:
+                raise
+            self.replaceIfStuck(pair, pipeline)
+            status, details = 503, 'Pipeline failed, please try again'
+        finally:
+            if self.inflight.get(segmentId) is cancel:
+                del self.inflight[segmentId]
+        if status == 200:
+            self.stats['timing'].add(pair, len(toTranslate), time.time() - started)
+            metrics.requests.inc(('%s-%s' % pair, ))
+            self.reply({'id': segmentId,
+                        'translatedText': self.maybeStripMarks(self.markUnknown, pair, translated),
+                        'responseStatus': 200})
+        else:
+            self.reply({'id': segmentId, 'responseDetails': details, 'responseStatus': status})
+        self.cleanPairs()
+
+    def on_close(self):
+        for segmentId in list(self.inflight):
+            self.cancelSegment(segmentId)
+
+
+class AnalyzeHandler(TranslateHandler):
 
     def postproc_text(self, in_text, result):
         lexical_units = removeDotFromDeformat(in_text, re.findall(r'\^([^\$]*)\$([^\^]*)', result))
@@ -605,16 +1195,18 @@ class AnalyzeHandler(BaseHandler):
         in_text = self.get_argument('q')
         in_mode = toAlpha3Code(self.get_argument('lang'))
         if in_mode in self.analyzers:
-            [path, mode] = self.analyzers[in_mode]
-            formatting = 'txt'
-            commands = [['apertium', '-d', path, '-f', formatting, mode]]
-            result = yield translation.translateSimple(in_text, commands)
+            deadline = time.time() + self.timeout if self.timeout else None
+            try:
+                result = yield self.runMode(('analyzer', in_mode), in_text, 'apertium-destxt', 'apertium-retxt', deadline)
+            except (gen.TimeoutError, tornado.iostream.StreamClosedError) as e:
+                self.sendModeError(e)
+                return
             self.sendResponse(self.postproc_text(in_text, result))
         else:
             self.send_error(400, explanation='That mode is not installed')
 
 
-class GenerateHandler(BaseHandler):
+class GenerateHandler(TranslateHandler):
 
     def preproc_text(self, in_text):
         lexical_units = re.findall(r'(\^[^\$]*\$[^\^]*)', in_text)
@@ -633,11 +1225,13 @@ class GenerateHandler(BaseHandler):
         in_text = self.get_argument('q')
         in_mode = toAlpha3Code(self.get_argument('lang'))
         if in_mode in self.generators:
-            [path, mode] = self.generators[in_mode]
-            formatting = 'none'
-            commands = [['apertium', '-d', path, '-f', formatting, mode]]
             lexical_units, to_generate = self.preproc_text(in_text)
-            result = yield translation.translateSimple(to_generate, commands)
+            deadline = time.time() + self.timeout if self.timeout else None
+            try:
+                result = yield self.runMode(('generator', in_mode), to_generate, False, False, deadline)
+            except (gen.TimeoutError, tornado.iostream.StreamClosedError) as e:
+                self.sendModeError(e)
+                return
             self.sendResponse(self.postproc_text(lexical_units, result))
         else:
             self.send_error(400, explanation='That mode is not installed')
@@ -670,7 +1264,110 @@ class ListLanguageNamesHandler(BaseHandler):
             self.sendResponse({})
 
 
-class PerWordHandler(BaseHandler):
+class PerWordHandler(TranslateHandler):
+
+    lexicalUnitRE = re.compile(r'\^([^\$]*)\$')
+    cancel = None  # Future set when the client goes away
+
+    def on_connection_close(self):
+        if self.cancel is not None and not self.cancel.done():
+            self.cancel.set_result(None)
+
+    @gen.coroutine
+    def analyse(self, key, query, deadline):
+        analysis = yield self.runMode(key, query, 'apertium-destxt', 'apertium-retxt', deadline, self.cancel)
+        raise gen.Return(removeDotFromDeformat(query, re.findall(self.lexicalUnitRE, analysis)))
+
+    def sharesAnalysis(self, lang):
+        """Whether the tagger of lang starts by running its analyzer,
+        so we can tag the analysis rather than analyse twice."""
+        if lang not in self.analyzers or lang not in self.taggers:
+            return False
+        analyzer, tagger = self.getPipeCmds('analyzer', lang), self.getPipeCmds('tagger', lang)
+        return (analyzer.do_flush and tagger.do_flush and
+                len(analyzer.commands) < len(tagger.commands) and
+                tagger.commands[:len(analyzer.commands)] == analyzer.commands)
+
+    @gen.coroutine
+    def analyseAndTag(self, lang, query, deadline):
+        """(morph, tagger) lexical units of query, from one run through
+        the analyzer, whose output goes on through the rest of the
+        tagger."""
+        # Only the lexical units are used, so no need to reformat:
+        analysis = yield self.runMode(('analyzer', lang), query, 'apertium-destxt', False, deadline, self.cancel)
+        tagged = yield self.runMode(('disambiguator', lang), analysis, False, False, deadline, self.cancel)
+        raise gen.Return((removeDotFromDeformat(query, re.findall(self.lexicalUnitRE, analysis)),
+                          removeDotFromDeformat(query, re.findall(self.lexicalUnitRE, tagged))))
+
+    @gen.coroutine
+    def bilingualTranslate(self, lexicalUnits, lang, deadline):
+        """The bilingual translations of the analyses of each of
+        lexicalUnits, looked up together in a persistent lt-proc -b."""
+        inputs = []
+        for lexicalUnit in lexicalUnits:
+            splitUnit = lexicalUnit.split('/')
+            forms = splitUnit[1:] if len(splitUnit) > 1 else splitUnit
+            inputs.append(''.join(['^%s$' % form for form in forms]))
+        unique = list(set(inputs))
+        key = ('biltrans', lang)
+        pipeline = self.getPipeline(key)
+        try:
+            outputs = yield gen.multi_future(pipeline.translateMany(unique, False, False, deadline, cancel=self.cancel),
+                                             quiet_exceptions=translation.CHUNK_ERRORS)
+        except (gen.TimeoutError, tornado.iostream.StreamClosedError):
+            self.replaceIfStuck(key, pipeline)
+            raise
+        translations = {toTranslate: ['/'.join(x.split('/')[1:]) for x in re.findall(self.lexicalUnitRE, output)]
+                        for toTranslate, output in zip(unique, outputs)}
+        raise gen.Return([translations[toTranslate] for toTranslate in inputs])
+
+    @gen.coroutine
+    def processPerWord(self, lang, modes, query, deadline):
+        """(outputs, tagger_lexicalUnits, morph_lexicalUnits), or None
+        if a mode we need isn't installed or gave no output."""
+        outputs = {}
+        morph_lexicalUnits = None
+        tagger_lexicalUnits = None
+        analyses = {}
+        needMorph = 'morph' in modes or 'biltrans' in modes
+        needTagger = 'tagger' in modes or 'disambig' in modes or 'translate' in modes
+
+        if (needMorph and lang not in self.analyzers) or (needTagger and lang not in self.taggers):
+            raise gen.Return(None)
+        if needMorph and needTagger and self.sharesAnalysis(lang):
+            analyses['morph'], analyses['tagger'] = yield self.analyseAndTag(lang, query, deadline)
+        else:
+            if needMorph:
+                analyses['morph'] = self.analyse(('analyzer', lang), query, deadline)
+            if needTagger:
+                analyses['tagger'] = self.analyse(('tagger', lang), query, deadline)
+            analyses = yield gen.multi_future(analyses, quiet_exceptions=translation.CHUNK_ERRORS)
+
+        if 'morph' in analyses:
+            morph_lexicalUnits = analyses['morph']
+            outputs['morph'] = [lexicalUnit.split('/')[1:] for lexicalUnit in morph_lexicalUnits]
+            outputs['morph_inputs'] = [stripTags(lexicalUnit.split('/')[0]) for lexicalUnit in morph_lexicalUnits]
+        if 'tagger' in analyses:
+            tagger_lexicalUnits = analyses['tagger']
+            outputs['tagger'] = [lexicalUnit.split('/')[1:] if '/' in lexicalUnit else lexicalUnit
+                                 for lexicalUnit in tagger_lexicalUnits]
+            outputs['tagger_inputs'] = [stripTags(lexicalUnit.split('/')[0]) for lexicalUnit in tagger_lexicalUnits]
+
+        translations = {}
+        if 'biltrans' in modes:
+            if not morph_lexicalUnits:
+                raise gen.Return(None)
+            translations['biltrans'] = self.bilingualTranslate(morph_lexicalUnits, lang, deadline)
+            outputs['translate_inputs'] = outputs['morph_inputs']
+        if 'translate' in modes:
+            if not tagger_lexicalUnits:
+                raise gen.Return(None)
+            translations['translate'] = self.bilingualTranslate(tagger_lexicalUnits, lang, deadline)
+            outputs['translate_inputs'] = outputs['tagger_inputs']
+        translations = yield gen.multi_future(translations, quiet_exceptions=translation.CHUNK_ERRORS)
+        outputs.update(translations)
+
+        raise gen.Return((outputs, tagger_lexicalUnits, morph_lexicalUnits))
 
     @tornado.web.asynchronous
     @gen.coroutine
@@ -698,9 +1395,6 @@ class PerWordHandler(BaseHandler):
             if output is None:
                 self.send_error(400, explanation='No output')
                 return
-            elif not output:
-                self.send_error(408, explanation='Request timed out')
-                return
             else:
                 outputs, tagger_lexicalUnits, morph_lexicalUnits = output
 
@@ -725,23 +1419,33 @@ class PerWordHandler(BaseHandler):
             else:
                 self.sendResponse(toReturn)
 
-        pool = Pool(processes=1)
-        result = pool.apply_async(processPerWord, (self.analyzers, self.taggers, lang, modes, query))
-        pool.close()
-
-        @run_async_thread
-        def worker(callback):
-            try:
-                callback(result.get(timeout=self.timeout))
-            except TimeoutError:
-                pool.terminate()
-                callback(None)
-
-        output = yield tornado.gen.Task(worker)
+        deadline = time.time() + self.timeout if self.timeout else None
+        self.cancel = Future()
+        try:
+            output = yield self.processPerWord(lang, modes, query, deadline)
+        except translation.Cancelled:
+            return
+        except (gen.TimeoutError, tornado.iostream.StreamClosedError) as e:
+            self.sendModeError(e)
+            return
         handleOutput(output)
 
 
-class CoverageHandler(BaseHandler):
+class CoverageHandler(TranslateHandler):
+
+    @gen.coroutine
+    def getCoverage(self, lang, text, deadline, penalize=False):
+        """Coverage of text by the analyzer of lang, once it's our turn
+        among the coverage_concurrency analyses we let run at once."""
+        try:
+            yield self.coverage_semaphore.acquire(None if deadline is None else timedelta(seconds=max(0, deadline - time.time())))
+        except translation.LockTimeout:
+            raise gen.TimeoutError('Timed out waiting to compute coverage')
+        try:
+            analysis = yield self.runMode(('analyzer', lang), text, 'apertium-destxt', 'apertium-retxt', deadline)
+        finally:
+            self.coverage_semaphore.release()
+        raise gen.Return(calcCoverage(text, analysis, penalize=penalize))
 
     @tornado.web.asynchronous
     @gen.coroutine
@@ -752,38 +1456,27 @@ class CoverageHandler(BaseHandler):
             self.send_error(400, explanation='Missing q argument')
             return
 
-        def handleCoverage(coverage):
-            if coverage is None:
-                self.send_error(408, explanation='Request timed out')
-            else:
-                self.sendResponse([coverage])
-
         if mode in self.analyzers:
-            pool = Pool(processes=1)
-            result = pool.apply_async(getCoverage, [text, self.analyzers[mode][0], self.analyzers[mode][1]])
-            pool.close()
-
-            @run_async_thread
-            def worker(callback):
-                try:
-                    callback(result.get(timeout=self.timeout))
-                except TimeoutError:
-                    pool.terminate()
-                    callback(None)
-
-            coverage = yield tornado.gen.Task(worker)
-            handleCoverage(coverage)
+            deadline = time.time() + self.timeout if self.timeout else None
+            try:
+                coverage = yield self.getCoverage(mode, text, deadline)
+            except (gen.TimeoutError, tornado.iostream.StreamClosedError) as e:
+                self.sendModeError(e)
+                return
+            self.sendResponse([coverage])
         else:
             self.send_error(400, explanation='That mode is not installed')
 
 
-class IdentifyLangHandler(BaseHandler):
+class IdentifyLangHandler(CoverageHandler):
 
     @tornado.web.asynchronous
+    @gen.coroutine
     def get(self):
         text = self.get_argument('q')
         if not text:
-            return self.send_error(400, explanation='Missing q argument')
+            self.send_error(400, explanation='Missing q argument')
+            return
 
         if cld2:
             cldResults = cld2.detect(text)
@@ -793,19 +1486,15 @@ class IdentifyLangHandler(BaseHandler):
             else:
                 self.sendResponse({'nob': 100})  # TODO: Some more reasonable response
         else:
-            def handleCoverages(coverages):
-                self.sendResponse(coverages)
-
-            pool = Pool(processes=1)
-            result = pool.apply_async(getCoverages, [text, self.analyzers], {'penalize': True}, callback=handleCoverages)
-            pool.close()
+            deadline = time.time() + self.timeout if self.timeout else None
+            langs = list(self.analyzers)
             try:
-                result.get(timeout=self.timeout)
-                # coverages = result.get(timeout=self.timeout)
-                # TODO: Coverages are not actually sent!!
-            except TimeoutError:
-                self.send_error(408, explanation='Request timed out')
-                pool.terminate()
+                coverages = yield gen.multi_future([self.getCoverage(lang, text, deadline, penalize=True) for lang in langs],
+                                                   quiet_exceptions=translation.CHUNK_ERRORS)
+            except (gen.TimeoutError, tornado.iostream.StreamClosedError) as e:
+                self.sendModeError(e)
+                return
+            self.sendResponse(dict(zip(langs, coverages)))
 
 
 class GetLocaleHandler(BaseHandler):
@@ -932,7 +1621,11 @@ class PipeDebugHandler(BaseHandler):
             self.send_error(500)
             return
 
-        res = yield translation.translatePipeline(toTranslate, commands)
+        try:
+            res = yield translation.translatePipeline(toTranslate, commands, self.timeout)
+        except gen.TimeoutError:
+            self.send_error(408, explanation='Request timed out')
+            return
         if self.get_status() != 200:
             self.send_error(self.get_status())
             return
@@ -949,12 +1642,18 @@ class PipeDebugHandler(BaseHandler):
 def setupHandler(
     port, pairs_path, nonpairs_path, langNames, missingFreqsPath, timeout,
     max_pipes_per_pair, min_pipes_per_pair, max_users_per_pipe, max_idle_secs, restart_pipe_after,
-    verbosity=0, scaleMtLogs=False, memory=1000
+    verbosity=0, scaleMtLogs=False, memory=1000, batch_window_ms=0, batch_max_bytes=4096,
+    cache_size=0, cache_ttl=0, shared_cache_path=None, shared_cache_size=0, sentence_cache_size=0,
+    autoscale_wait_ms=50, useCountsPath=None, total_max_pipes=0, total_max_rss=0,
+    restart_rss_growth=2.0, restart_latency_growth=0, short_request_chars=1000,
+    max_batch_segments=1000, max_batch_chars=100000, coverage_concurrency=4
 ):
 
-    global missingFreqsDb
+    global missingFreqsDb, useCountDb
     if missingFreqsPath:
         missingFreqsDb = missingdb.MissingDb(missingFreqsPath, memory)
+    if useCountsPath:
+        useCountDb = usecountdb.UseCountDb(useCountsPath)
 
     Handler = BaseHandler
     Handler.langNames = langNames
@@ -964,6 +1663,24 @@ def setupHandler(
     Handler.max_users_per_pipe = max_users_per_pipe
     Handler.max_idle_secs = max_idle_secs
     Handler.restart_pipe_after = restart_pipe_after
+    Handler.restart_rss_growth = restart_rss_growth
+    Handler.restart_latency_growth = restart_latency_growth
+    Handler.short_request_chars = short_request_chars
+    Handler.max_batch_segments = max_batch_segments
+    Handler.max_batch_chars = max_batch_chars
+    Handler.coverage_semaphore = locks.Semaphore(coverage_concurrency)
+    Handler.total_max_pipes = total_max_pipes
+    Handler.total_max_rss = total_max_rss
+    Handler.autoscaler = Autoscaler(min_pipes_per_pair, max_pipes_per_pair, max_users_per_pipe, autoscale_wait_ms / 1000)
+    Handler.batch_window_ms = batch_window_ms
+    Handler.batch_max_bytes = batch_max_bytes
+    if shared_cache_path:
+        shared_cache = SharedTranslationCache(shared_cache_path, shared_cache_size, cache_ttl)
+        Handler.translation_cache = TranslationCache(cache_size, cache_ttl, shared=shared_cache)
+    elif cache_size > 0:
+        Handler.translation_cache = TranslationCache(cache_size, cache_ttl)
+    if sentence_cache_size > 0:
+        Handler.sentence_cache = TranslationCache(sentence_cache_size, cache_ttl)
     Handler.scaleMtLogs = scaleMtLogs
     Handler.verbosity = verbosity
 
@@ -1019,10 +1736,56 @@ if __name__ == '__main__':
                         help='when shutting down pipelines, keep at least this many open per language pair (default = 0)', type=int, default=0)
     parser.add_argument('-u', '--max-users-per-pipe',
                         help='how many concurrent requests per pipeline before we consider spinning up a new one (default = 5)', type=int, default=5)
+    parser.add_argument('-tp', '--total-max-pipes',
+                        help='if specified, shut down idle pipelines of other pairs to keep at most this many pipelines running in each process', type=int, default=0)
+    parser.add_argument('-tr', '--total-max-rss',
+                        help='if specified, shut down idle pipelines of other pairs to keep the pipelines of each process under this many bytes of RSS', type=int, default=0)
+    parser.add_argument('-ps', '--pipe-sample-secs',
+                        help='how often to sample the memory and CPU use of pipelines, shown in /stats (default = 10; 0 to never)', type=int, default=10)
+    parser.add_argument('-sr', '--short-request-chars',
+                        help='translation requests of up to this many characters get ahead of longer ones (default = 1000)', type=int, default=1000)
+    parser.add_argument('-aw', '--autoscale-wait-ms',
+                        help='start another pipeline for a pair when its chunks wait this many milliseconds on average for room in one (default = 50; 0 to only scale on traffic)',
+                        type=int, default=50)
     parser.add_argument('-m', '--max-idle-secs',
                         help='if specified, shut down pipelines that have not been used in this many seconds', type=int, default=0)
     parser.add_argument('-r', '--restart-pipe-after',
-                        help='restart a pipeline if it has had this many requests (default = 1000)', type=int, default=1000)
+                        help='if specified, restart a pipeline after this many requests', type=int, default=0)
+    parser.add_argument('-rg', '--restart-rss-growth',
+                        help='restart a pipeline when its RSS grows to this many times what it was once warmed up (default = 2; 0 to never)',
+                        type=float, default=2.0)
+    parser.add_argument('-rl', '--restart-latency-growth',
+                        help='if specified, restart a pipeline when it gets this many times slower per byte than it has been at its best',
+                        type=float, default=0)
+    parser.add_argument('-bw', '--batch-window-ms',
+                        help='if specified, let translation chunks queue up this many milliseconds so they can be written to the pipeline together', type=int, default=0)
+    parser.add_argument('-bb', '--batch-max-bytes',
+                        help='write a batch of queued chunks as soon as it reaches this many bytes (default = 4096)', type=int, default=4096)
+    parser.add_argument('-ms', '--max-batch-segments',
+                        help='how many segments a /translateBatch request may have (default = 1000)', type=int, default=1000)
+    parser.add_argument('-mc', '--max-batch-chars',
+                        help='how many characters a /translateBatch request may have in all (default = 100000)', type=int, default=100000)
+    parser.add_argument('-cc', '--coverage-concurrency',
+                        help='how many analyses for /calcCoverage and /identifyLang to run at once in each process (default = 4)',
+                        type=int, default=4)
+    parser.add_argument('-cs', '--cache-size',
+                        help='if specified, cache up to this many bytes of translations in memory', type=int, default=0)
+    parser.add_argument('-ct', '--cache-ttl',
+                        help='if specified, forget cached translations after this many seconds', type=int, default=0)
+    parser.add_argument('-sc', '--shared-cache',
+                        help='if specified, also cache translations in this sqlite database, shared by all processes (see -j)', default=None)
+    parser.add_argument('-ss', '--shared-cache-size',
+                        help='how many bytes of translations to keep in the shared cache (default = 100000000)', type=int, default=100000000)
+    parser.add_argument('-scs', '--sentence-cache-size',
+                        help='if specified, translate sentence by sentence, caching up to this many bytes of translated sentences', type=int, default=0)
+    parser.add_argument('-pp', '--prewarm-pairs',
+                        help='comma-separated pairs (e.g. eng-spa,spa-eng) to start pipelines for before reporting ready', default=None)
+    parser.add_argument('-pn', '--prewarm-top',
+                        help='also start pipelines for this many of the most used pairs according to --use-counts', type=int, default=0)
+    parser.add_argument('-uc', '--use-counts',
+                        help='path to sqlite database keeping track of how much each pair is used, across restarts (default = None)', default=None)
+    parser.add_argument('-md', '--metrics-dir',
+                        help='directory where the processes started by -j share their /metrics (default = a new temporary directory)', default=None)
     parser.add_argument('-v', '--verbosity', help='logging verbosity', type=int, default=0)
     parser.add_argument('-V', '--version', help='show APY version', action='version', version="%(prog)s version " + __version__)
     parser.add_argument('-S', '--scalemt-logs', help='generates ScaleMT-like logs; use with --log-path; disables', action='store_true')
@@ -1035,6 +1798,8 @@ if __name__ == '__main__':
     parser.add_argument('-b', '--bypass-token', help="ReCAPTCHA bypass token", action='store_true')
     parser.add_argument('-rs', '--recaptcha-secret', help="ReCAPTCHA secret for suggestion validation", default=None)
     args = parser.parse_args()
+    if args.prewarm_top and not args.use_counts:
+        parser.error('--prewarm-top needs --use-counts')
 
     if args.daemon:
         # regular content logs are output stderr
@@ -1059,7 +1824,7 @@ if __name__ == '__main__':
             logging.getLogger("tornado.access").propagate = False
 
     if args.stat_period_max_age:
-        BaseHandler.STAT_PERIOD_MAX_AGE = timedelta(0, args.stat_period_max_age, 0)
+        BaseHandler.stats['timing'] = TimingStats(args.stat_period_max_age)
 
     if not cld2:
         logging.warning("Unable to import CLD2, continuing using naive method of language detection")
@@ -1067,17 +1832,25 @@ if __name__ == '__main__':
         logging.warning("Unable to import chardet, assuming utf-8 encoding for all websites")
 
     setupHandler(args.port, args.pairs_path, args.nonpairs_path, args.lang_names, args.missing_freqs, args.timeout, args.max_pipes_per_pair,
-                 args.min_pipes_per_pair, args.max_users_per_pipe, args.max_idle_secs, args.restart_pipe_after, args.verbosity, args.scalemt_logs, args.unknown_memory_limit)
+                 args.min_pipes_per_pair, args.max_users_per_pipe, args.max_idle_secs, args.restart_pipe_after, args.verbosity, args.scalemt_logs, args.unknown_memory_limit,
+                 args.batch_window_ms, args.batch_max_bytes, args.cache_size, args.cache_ttl,
+                 args.shared_cache, args.shared_cache_size, args.sentence_cache_size, args.autoscale_wait_ms,
+                 args.use_counts, args.total_max_pipes, args.total_max_rss,
+                 args.restart_rss_growth, args.restart_latency_growth, args.short_request_chars,
+                 args.max_batch_segments, args.max_batch_chars, args.coverage_concurrency)
 
     application = tornado.web.Application([
         (r'/', RootHandler),
         (r'/list', ListHandler),
         (r'/listPairs', ListHandler),
         (r'/stats', StatsHandler),
+        (r'/metrics', MetricsHandler),
         (r'/translate', TranslateHandler),
         (r'/translateDoc', TranslateDocHandler),
         (r'/translatePage', TranslatePageHandler),
         (r'/translateRaw', TranslateRawHandler),
+        (r'/translateBatch', TranslateBatchHandler),
+        (r'/translateSocket', TranslateSocketHandler),
         (r'/analy[sz]e', AnalyzeHandler),
         (r'/generate', GenerateHandler),
         (r'/listLanguageNames', ListLanguageNamesHandler),
@@ -1126,10 +1899,43 @@ if __name__ == '__main__':
     signal.signal(signal.SIGTERM, sig_handler)
     signal.signal(signal.SIGINT, sig_handler)
 
+    prewarmPairs = args.prewarm_pairs.split(',') if args.prewarm_pairs else []
+    if args.prewarm_top:
+        prewarmPairs += [pair for pair in useCountDb.top(args.prewarm_top) if pair not in prewarmPairs]
+        # The forked processes need their own connections:
+        useCountDb.closeDb()
+    for pair in prewarmPairs:
+        if pair not in BaseHandler.pairs:
+            logging.warning('Not pre-warming unknown pair %s', pair)
+    prewarmPairs = [tuple(pair.split('-', 1)) for pair in prewarmPairs if pair in BaseHandler.pairs]
+
+    if args.num_processes != 1:
+        # Each process gets its own metrics after the fork
+        BaseHandler.metrics_dir = args.metrics_dir or tempfile.mkdtemp(prefix='apertium-apy-metrics-')
+
     http_server.bind(args.port)
     http_server.start(args.num_processes)
 
+    if BaseHandler.metrics_dir:
+        tornado.ioloop.PeriodicCallback(lambda: metrics.registry.dump(BaseHandler.metrics_dir), 5000).start()
+    if args.max_pipes_per_pair > 1:
+        tornado.ioloop.PeriodicCallback(TranslateHandler.scalePipelines, 1000).start()
+    if args.timeout:
+        tornado.ioloop.PeriodicCallback(TranslateHandler.checkPipelines, 1000).start()
+    if useCountDb is not None:
+        tornado.ioloop.PeriodicCallback(useCountDb.commit, 60000).start()
+    if args.pipe_sample_secs and os.path.isdir('/proc'):
+        tornado.ioloop.PeriodicCallback(TranslateHandler.samplePipelines, 1000 * args.pipe_sample_secs).start()
+
     loop = tornado.ioloop.IOLoop.instance()
+    if prewarmPairs:
+        # Every forked process needs its own pipelines
+        logging.info('Pre-warming pipelines for %s …', ', '.join('%s-%s' % pair for pair in prewarmPairs))
+
+        @gen.coroutine
+        def prewarm():
+            yield [TranslateHandler.prewarmPipelines(pair) for pair in prewarmPairs]
+        loop.run_sync(prewarm)
     wd = systemd.setup_watchdog()
     if wd is not None:
         wd.systemd_ready()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 sts=4 et :
+
+import math
+from bisect import bisect_left
+from time import time
+
+# Upper bounds (in seconds) of the latency histogram bins, from 1 ms to
+# about 23 s; anything slower goes in one last bin.
+LATENCY_BOUNDS = [0.001 * 2 ** (i / 2) for i in range(30)]
+
+
+class Buckets(object):
+    """A ring of count buckets, each summing up the requests of width
+    seconds. Buckets older than count*width seconds get reused, so
+    memory use stays the same no matter the traffic."""
+
+    def __init__(self, width, count):
+        self.width = width
+        self.count = count
+        self.epochs = [None] * count  # which width-second period each bucket is for
+        self.firsts = [None] * count  # time of the first request in each bucket
+        self.requests = [0] * count
+        self.chars = [0] * count
+        self.seconds = [0.0] * count
+        self.latencies = [[0] * (len(LATENCY_BOUNDS) + 1) for _ in range(count)]
+
+    def add(self, now, chars, seconds):
+        epoch = int(now // self.width)
+        i = epoch % self.count
+        if self.epochs[i] != epoch:
+            self.epochs[i] = epoch
+            self.firsts[i] = now
+            self.requests[i] = 0
+            self.chars[i] = 0
+            self.seconds[i] = 0.0
+            self.latencies[i] = [0] * (len(LATENCY_BOUNDS) + 1)
+        self.requests[i] += 1
+        self.chars[i] += chars
+        self.seconds[i] += seconds
+        self.latencies[i][bisect_left(LATENCY_BOUNDS, seconds)] += 1
+
+    def window(self, now, seconds):
+        """Sum up the buckets covering the last seconds (at most
+        count*width) before now."""
+        total = Window()
+        epoch = int(now // self.width)
+        n = min(self.count, int(math.ceil(seconds / self.width)))
+        for e in range(epoch - n + 1, epoch + 1):
+            i = e % self.count
+            if self.epochs[i] == e and self.requests[i]:
+                total.add(self.firsts[i], self.requests[i], self.chars[i], self.seconds[i], self.latencies[i])
+        return total
+
+
+class Window(object):
+    """Sums of a range of buckets."""
+
+    def __init__(self):
+        self.first = None  # time of the first request
+        self.requests = 0
+        self.chars = 0
+        self.seconds = 0.0
+        self.latencies = [0] * (len(LATENCY_BOUNDS) + 1)
+
+    def add(self, first, requests, chars, seconds, latencies):
+        if self.first is None or first < self.first:
+            self.first = first
+        self.requests += requests
+        self.chars += chars
+        self.seconds += seconds
+        self.latencies = [a + b for a, b in zip(self.latencies, latencies)]
+
+    def percentile(self, p):
+        """Upper bound of the latency bin holding the p'th percentile."""
+        if not self.requests:
+            return 0.0
+        rank = p / 100 * self.requests
+        seen = 0
+        for i, n in enumerate(self.latencies):
+            seen += n
+            if seen >= rank:
+                break
+        return LATENCY_BOUNDS[min(i, len(LATENCY_BOUNDS) - 1)]
+
+    def toJson(self, now):
+        return {
+            'requests': self.requests,
+            'totChars': self.chars,
+            'totTimeSpent': round(self.seconds, 6),
+            'charsPerSec': round(self.chars / self.seconds, 2) if self.seconds else 0.0,
+            'ageFirstRequest': now - self.first if self.first is not None else 0,
+            'latency': {
+                'p50': round(self.percentile(50), 4),
+                'p90': round(self.percentile(90), 4),
+                'p99': round(self.percentile(99), 4)
+            }
+        }
+
+
+class TimingStats(object):
+    """Requests, characters and time spent, overall and per pair, kept
+    per second for the last minute and per minute for the last maxAge
+    seconds."""
+
+    WINDOWS = [('1m', 60), ('5m', 300), ('1h', 3600)]
+
+    def __init__(self, maxAge=3600):
+        self.maxAge = maxAge
+        self.total = self.makeBuckets()
+        self.pairs = {}  # pair: (per-second Buckets, per-minute Buckets)
+
+    def makeBuckets(self):
+        return (Buckets(1, 60),
+                Buckets(60, max(1, int(math.ceil(self.maxAge / 60)))))
+
+    def add(self, pair, chars, seconds, now=None):
+        if now is None:
+            now = time()
+        if pair not in self.pairs:
+            self.pairs[pair] = self.makeBuckets()
+        for buckets in self.total + self.pairs[pair]:
+            buckets.add(now, chars, seconds)
+
+    def window(self, seconds, pair=None, now=None):
+        if now is None:
+            now = time()
+        perSecond, perMinute = self.total if pair is None else self.pairs[pair]
+        if seconds <= perSecond.count * perSecond.width:
+            return perSecond.window(now, seconds)
+        else:
+            return perMinute.window(now, min(seconds, self.maxAge))
+
+    def toJson(self, now=None):
+        if now is None:
+            now = time()
+        windows = {}
+        for name, seconds in self.WINDOWS:
+            if seconds > self.maxAge:
+                continue
+            windows[name] = self.window(seconds, now=now).toJson(now)
+            windows[name]['pairs'] = {}
+            for pair in self.pairs:
+                window = self.window(seconds, pair, now)
+                if window.requests:
+                    windows[name]['pairs']['%s-%s' % pair] = window.toJson(now)
+        return windows
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+"""Compare translation.splitForTranslation with the splitter it
+replaced, on inputs from 1 KB to 1 MB. The old one stopped after 10
+chunks, dropping the rest of the text, so we time it without that cap
+to compare the same amount of work; the "kept" column shows how much
+of the text it used to keep.
+
+Run from the top directory of apertium-apy:
+
+    python3 tools/benchmark-split.py
+
+"""
+
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from translation import splitForTranslation, PIPE_BUF  # noqa: E402
+
+
+def oldUpToBytes(string, max_bytes):
+    b = bytes(string, 'utf-8')
+    n = max_bytes
+    while n:
+        try:
+            dec = b[:n].decode('utf-8')
+            return len(dec)
+        except UnicodeDecodeError:
+            n -= 1
+    return 0
+
+
+def oldHardbreakFn(string, n_users):
+    if n_users > 2:
+        return 1000
+    else:
+        return oldUpToBytes(string, PIPE_BUF)
+
+
+def oldPreferPunctBreak(string, last, hardbreak):
+    if len(string[last:]) <= hardbreak:
+        return last + hardbreak + 1
+
+    softbreak = int(hardbreak / 2) + 1
+    softnext = last + softbreak
+    hardnext = last + hardbreak
+    dot = string.rfind(".", softnext, hardnext)
+    if dot > -1:
+        return dot + 1
+    else:
+        space = string.rfind(" ", softnext, hardnext)
+        if space > -1:
+            return space + 1
+        else:
+            return hardnext
+
+
+def oldSplitForTranslation(toTranslate, n_users, maxRounds=10):
+    allSplit = []
+    last = 0
+    rounds = 0
+    while last < len(toTranslate) and (maxRounds is None or rounds < maxRounds):
+        rounds += 1
+        hardbreak = oldHardbreakFn(toTranslate[last:], n_users)
+        next = oldPreferPunctBreak(toTranslate, last, hardbreak)
+        allSplit.append(toTranslate[last:next])
+        last = next
+    return allSplit
+
+
+def makeText(size):
+    """Roughly size bytes of sentences, with some non-ASCII words."""
+    words = ['the', 'cat', 'sat', 'on', 'mat', 'çà', 'überall', 'дом', 'ευχαριστώ']
+    text = []
+    length = 0
+    while length < size:
+        sentence = ' '.join(random.choice(words) for _ in range(random.randint(3, 20))) + '. '
+        text.append(sentence)
+        length += len(sentence.encode('utf-8'))
+    return ''.join(text)
+
+
+def main():
+    random.seed(1)
+    print('%10s %8s %12s %12s %10s %10s' % ('bytes', 'users', 'old ms', 'new ms', 'old kept', 'new kept'))
+    for size in [1000, 10000, 100000, 1000000]:
+        text = makeText(size)
+        for n_users in [1, 3]:
+            runs = max(1, 100000 // size)
+            old = timeit.timeit(lambda: oldSplitForTranslation(text, n_users, maxRounds=None), number=runs) / runs
+            new = timeit.timeit(lambda: splitForTranslation(text, n_users), number=runs) / runs
+            oldKept = sum(len(part) for part in oldSplitForTranslation(text, n_users)) / len(text)
+            newKept = sum(len(part) for part in splitForTranslation(text, n_users)) / len(text)
+            print('%10d %8d %12.3f %12.3f %9.1f%% %9.1f%%' % (
+                len(text.encode('utf-8')), n_users, old * 1000, new * 1000, oldKept * 100, newKept * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,23 +4,66 @@ from subprocess import Popen, PIPE
 from tornado import gen
 import tornado.process
 import tornado.iostream
+import tornado.ioloop
+from tornado.concurrent import Future
 try:  # >=4.2
     import tornado.locks as locks
 except ImportError:
     import toro as locks
 import logging
+import procstat
 from select import PIPE_BUF
 from contextlib import contextmanager
-from collections import namedtuple
+from collections import namedtuple, deque
+import heapq
+from datetime import timedelta
 from time import time
 
+# toro raises its own exception when a wait times out:
+LockTimeout = getattr(locks, 'Timeout', gen.TimeoutError)
+
+# Lower goes first when waiting for room in a FlushingStream:
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+
+
+class Cancelled(Exception):
+    pass
+
+
+# What all the chunks of a request may fail with at once, so
+# gen.multi_future shouldn't log every one of them:
+CHUNK_ERRORS = (gen.TimeoutError, Cancelled, tornado.iostream.StreamClosedError)
+
+
+def unlessCancelled(cancel, future):
+    """future, or if cancel (a Future) is done first, a future failing
+    with Cancelled."""
+    if cancel is None:
+        return future
+    result = Future()
+
+    def done(f):
+        if result.done():
+            return
+        if f is cancel:
+            result.set_exception(Cancelled())
+        elif f.exception() is not None:
+            result.set_exception(f.exception())
+        else:
+            result.set_result(f.result())
+    future.add_done_callback(done)
+    cancel.add_done_callback(done)
+    return result
+
 
 class Pipeline(object):
 
-    def __init__(self):
+    def __init__(self, timeout=None, stageTimer=None):
         # The lock is needed so we don't let two coroutines write
         # simultaneously to a pipeline; then the first call to read might
         # read translations of text put there by the second call …
+        # (FlushingPipeline instead keeps its writes and reads in
+        # order with a FlushingStream.)
         self.lock = locks.Lock()
         # The users count is how many requests have picked this
         # pipeline for translation. If this is 0, we can safely shut
@@ -28,6 +71,30 @@ class Pipeline(object):
         self.users = 0
         self.lastUsage = 0
         self.useCount = 0
+        # Seconds to allow each stage (deformat, reformat) of a
+        # translation; None means wait forever:
+        self.timeout = timeout
+        # If given, called with the name of a stage (queue, deformat,
+        # pipeline, reformat) and the seconds it took:
+        self.stageTimer = stageTimer
+        # Resource use of our processes as of the last sampleUsage:
+        self.rss = 0  # bytes
+        self.cpuSeconds = 0.0
+        self.cpuPercent = 0.0  # since the sample before
+        self.sampledAt = None
+        # What this pipeline looked like once warmed up, to tell if
+        # it's leaking or slowing down:
+        self.baseRss = None
+        self.secsPerByte = None  # moving average, see noteSpeed
+        self.baseSecsPerByte = None  # best moving average seen
+        # Set while a replacement is being started:
+        self.recycling = False
+        # Set once we've given up on and killed this pipeline:
+        self.stuck = False
+
+    # Requests before we trust the RSS and speed to be warmed up:
+    WARMUP_USES = 10
+    SPEED_ALPHA = 0.05
 
     @contextmanager
     def use(self):
@@ -43,37 +110,506 @@ class Pipeline(object):
     def __lt__(self, other):
         return self.users < other.users
 
+    def noteStage(self, stage, started):
+        if self.stageTimer is not None:
+            self.stageTimer(stage, time() - started)
+
+    def noteSpeed(self, size, seconds):
+        """Note that size bytes took seconds to get through the
+        pipeline itself (not counting queueing or formatting)."""
+        if self.secsPerByte is None:
+            self.secsPerByte = seconds / size
+        else:
+            self.secsPerByte += self.SPEED_ALPHA * (seconds / size - self.secsPerByte)
+        if self.useCount >= self.WARMUP_USES and (self.baseSecsPerByte is None or
+                                                  self.secsPerByte < self.baseSecsPerByte):
+            self.baseSecsPerByte = self.secsPerByte
+
+    def pids(self):
+        """PIDs of the processes this pipeline keeps running."""
+        return []
+
+    def checkStuck(self):
+        """Kill the pipeline (setting stuck) if it seems wedged; run
+        periodically, since a wedged request may time out long before
+        we can tell."""
+        pass
+
+    def sampleUsage(self, procs, now=None):
+        """Update rss and cpu* from a procstat.snapshot."""
+        if now is None:
+            now = time()
+        rss, cpuSeconds = procstat.treeTotals(procs, self.pids())
+        if self.sampledAt is not None and now > self.sampledAt:
+            # Formatters may have been restarted, so this can go down:
+            self.cpuPercent = max(0.0, 100 * (cpuSeconds - self.cpuSeconds) / (now - self.sampledAt))
+        self.rss, self.cpuSeconds, self.sampledAt = rss, cpuSeconds, now
+        if self.baseRss is None and self.useCount >= self.WARMUP_USES:
+            self.baseRss = rss
+
     @gen.coroutine
-    def translate(self, toTranslate, nosplit, deformat, reformat):
+    def translate(self, toTranslate, nosplit, deformat, reformat, memo=None, deadline=None, priority=PRIORITIES['normal'],
+                  cancel=None):
+        """deadline is the time() after which we raise gen.TimeoutError
+        rather than keep waiting for the translation; requests of better
+        priority (see PRIORITIES) may get ahead of those waiting. Once
+        the cancel Future (if given) is done, we raise Cancelled, and
+        drop what hasn't been written to the pipeline yet."""
         raise Exception("Not implemented, subclass me!")
 
+    def translateMany(self, texts, deformat=True, reformat=True, deadline=None, priority=PRIORITIES['normal'], cancel=None):
+        """A Future for the translation of each of texts; they fail (e.g.
+        time out) separately."""
+        return [self.translate(text, False, deformat, reformat, deadline=deadline, priority=priority, cancel=cancel)
+                for text in texts]
+
+
+# Linux' default pipe buffer size; we try to keep no more than this
+# in flight through a FlushingStream:
+PIPE_CAPACITY = 65536
+
+
+class FlushingStream(object):
+    """Lets several NUL-terminated segments be in flight through a
+    NUL-flushing process chain at once, so all of its stages can work at
+    the same time. Outputs come back in the order the inputs were
+    written, so we match them to their writers with a FIFO of futures.
+
+    Writers waiting for room are let in by priority, and in order of
+    arrival within the same priority, so short interactive requests
+    can get in between the chunks of long ones.
+
+    """
+
+    def __init__(self, proc_in, proc_out, max_inflight=PIPE_CAPACITY):
+        self.proc_in, self.proc_out = proc_in, proc_out
+        self.max_inflight = max_inflight
+        self.inflight = 0       # bytes written (or about to be) but not yet read back
+        self.pending = deque()  # (future, bytes written), oldest first
+        self.waiting = []       # heap of [priority, arrival, bytes, future], future None if given up
+        self.arrivals = 0
+        self.reading = False
+        self.lastProgress = time()  # of the last read, or the first write after an idle spell
+
+    @gen.coroutine
+    def submit(self, data):
+        """Write data, which should end in a \0, and return the output
+        up to and including the corresponding \0."""
+        outputs = yield self.submitMany([data])
+        return outputs[0]
+
+    def fits(self, size):
+        return self.inflight == 0 or self.inflight + size <= self.max_inflight
+
+    @gen.coroutine
+    def admit(self, size, priority, deadline, cancel=None):
+        """Wait until there's room for size more bytes in flight, and
+        reserve it."""
+        if deadline is not None and time() >= deadline:
+            raise gen.TimeoutError("Timed out waiting for room in the pipeline")
+        if cancel is not None and cancel.done():
+            raise Cancelled()
+        if self.fits(size) and (not self.waiting or priority < self.waiting[0][0]):
+            self.inflight += size
+            return
+        future = Future()
+        waiter = [priority, self.arrivals, size, future]
+        self.arrivals += 1
+        heapq.heappush(self.waiting, waiter)
+        try:
+            yield withTimeout(None if deadline is None else deadline - time(), unlessCancelled(cancel, future))
+        except (gen.TimeoutError, Cancelled) as e:
+            waiter[-1] = None
+            if future.done():
+                # Let in just as we gave up; give the room back:
+                self.inflight -= size
+                self.letIn()
+            if isinstance(e, Cancelled):
+                raise
+            raise gen.TimeoutError("Timed out waiting for room in the pipeline")
+
+    def letIn(self):
+        """Let in waiting writers, best first, for as long as the best
+        one fits."""
+        while self.waiting and (self.waiting[0][-1] is None or self.fits(self.waiting[0][2])):
+            _, _, size, future = heapq.heappop(self.waiting)
+            if future is not None:
+                self.inflight += size
+                future.set_result(None)
+
+    @gen.coroutine
+    def submitMany(self, segments, pipeline=None, deadline=None, priority=PRIORITIES['normal'], cancel=None):
+        """Like submit, but for a list of segments, which are written
+        together in one go. If pipeline is given, the time spent
+        waiting for room and in the stream are noted as its queue and
+        pipeline stages. After deadline (if given) we stop waiting,
+        either for room or for the outputs, with a gen.TimeoutError;
+        in the first case nothing gets written. The same goes for
+        cancel, with Cancelled."""
+        size = sum(len(data) for data in segments)
+        started = time()
+        yield self.admit(size, priority, deadline, cancel)
+        if pipeline is not None:
+            pipeline.noteStage('queue', started)
+            started = time()
+        if not self.pending:
+            self.lastProgress = time()
+        futures = []
+        for data in segments:
+            future = Future()
+            self.pending.append((future, len(data)))
+            futures.append(future)
+        self.proc_in.stdin.write(b''.join(segments))
+        # TODO: PipeIOStream has no flush, but seems to work anyway?
+        # proc_in.stdin.flush()
+        if not self.reading:
+            self.readLoop()
+        if deadline is None and cancel is None:
+            outputs = yield futures
+        else:
+            outputs = yield withTimeout(None if deadline is None else deadline - time(),
+                                        unlessCancelled(cancel, gen.multi_future(
+                                            futures, quiet_exceptions=(tornado.iostream.StreamClosedError,))))
+        if pipeline is not None:
+            pipeline.noteStage('pipeline', started)
+            if size:
+                pipeline.noteSpeed(size, time() - started)
+        return outputs
+
+    @gen.coroutine
+    def readLoop(self):
+        self.reading = True
+        try:
+            while self.pending:
+                # If the output has no \0, this hangs; the callers' deadlines
+                # get them out, and whoever notices (see stuckFor) closes us.
+                output = yield self.proc_out.stdout.read_until(bytes('\0', 'utf-8'))
+                self.lastProgress = time()
+                future, size = self.pending.popleft()
+                self.inflight -= size
+                self.letIn()
+                future.set_result(output)
+        except Exception as e:
+            # Nothing more is coming out of this one, so fail those
+            # waiting for output, and those waiting for room:
+            while self.pending:
+                future, _ = self.pending.popleft()
+                future.set_exception(e)
+            self.inflight = 0
+            while self.waiting:
+                future = heapq.heappop(self.waiting)[-1]
+                if future is not None:
+                    future.set_exception(e)
+        finally:
+            self.reading = False
+
+    def stuckFor(self):
+        """Seconds we've been waiting for output without getting any."""
+        return time() - self.lastProgress if self.pending else 0
+
+    def close(self, kill=False):
+        self.proc_in.stdin.close()
+        self.proc_out.stdout.close()
+        if kill:
+            self.proc_in.proc.kill()
+
 
 class FlushingPipeline(Pipeline):
 
-    def __init__(self, commands, *args, **kwargs):
-        self.inpipe, self.outpipe = startPipeline(commands)
+    def __init__(self, commands, batch_window_ms=0, batch_max_bytes=PIPE_BUF, *args, **kwargs):
+        self.procs = startProcs(commands)
+        self.inpipe, self.outpipe = self.procs[0], self.procs[-1]
+        self.stream = FlushingStream(self.inpipe, self.outpipe)
+        # Deformatters and reformatters are kept running alongside
+        # the pipeline in NUL-flushing mode, keyed by command name, so
+        # each chunk doesn't cost us a fork/exec of its own:
+        self.formatters = {}
+        # If batch_window_ms > 0, segments with the same
+        # (deformat, reformat) queue up for that long (or until they
+        # add up to batch_max_bytes), and then go through in one write:
+        self.batch_window_ms = batch_window_ms
+        self.batch_max_bytes = batch_max_bytes
+        self.batches = {}  # (deformat, reformat): Batch
         super().__init__(*args, **kwargs)
 
     def __del__(self):
         logging.debug("shutting down FlushingPipeline that was used %d times", self.useCount)
         self.inpipe.stdin.close()
         self.inpipe.stdout.close()
+        for formatter in self.formatters.values():
+            formatter.close()
         # TODO: It seems the process immediately becomes <defunct>,
         # but only completely removed after a second request to the
         # server – why?
 
+    def kill(self):
+        """Give up on this pipeline, failing anything in flight."""
+        self.stuck = True
+        self.stream.close()
+        for proc in self.procs:
+            try:
+                proc.proc.kill()
+            except OSError:
+                pass  # already gone
+
+    def checkStuck(self):
+        """Kill the pipeline if it hasn't put out anything for as long
+        as we allow a request to take."""
+        if not self.stuck and self.timeout is not None and self.stream.stuckFor() > self.timeout:
+            logging.warning("Pipeline has had no output for %d secs, killing it", self.stream.stuckFor())
+            self.kill()
+
+    def pids(self):
+        return ([proc.pid for proc in self.procs] +
+                [formatter.proc_in.pid for formatter in self.formatters.values()])
+
+    def getFormatter(self, cmd):
+        if cmd not in self.formatters:
+            logging.info("Starting up formatter %s for FlushingPipeline", cmd)
+            proc, _ = startPipeline([[cmd, '-z']])
+            self.formatters[cmd] = FlushingStream(proc, proc)
+        return self.formatters[cmd]
+
+    def dropFormatter(self, cmd, formatter, kill=False):
+        # Others sharing the formatter may already have replaced it:
+        if self.formatters.get(cmd) is formatter:
+            del self.formatters[cmd]
+            formatter.close(kill)
+
+    @gen.coroutine
+    def format(self, cmd, segments, deadline=None, priority=PRIORITIES['normal'], cancel=None):
+        """Send a list of NUL-terminated segments through the formatter
+        cmd, returning the list of its NUL-terminated outputs."""
+        formatter = self.getFormatter(cmd)
+        if self.timeout is not None and (deadline is None or deadline > time() + self.timeout):
+            deadline = time() + self.timeout
+        try:
+            outputs = yield formatter.submitMany(segments, deadline=deadline, priority=priority, cancel=cancel)
+        except gen.TimeoutError:
+            # A formatter that's just busy is fine, but a stuck one is
+            # useless to the next caller:
+            if self.timeout is not None and formatter.stuckFor() > self.timeout:
+                logging.warning("Formatter %s has had no output for %d secs, killing it", cmd, formatter.stuckFor())
+                self.dropFormatter(cmd, formatter, kill=True)
+            raise
+        except tornado.iostream.StreamClosedError:
+            # Let the next call start a fresh one:
+            self.dropFormatter(cmd, formatter)
+            raise ProcessFailure("%s closed its output" % cmd)
+        return outputs
+
+    @gen.coroutine
+    def submit(self, segments, deadline=None, priority=PRIORITIES['normal'], cancel=None):
+        """Send a list of NUL-terminated segments through the pipeline
+        itself (see FlushingStream.submitMany)."""
+        try:
+            outputs = yield self.stream.submitMany(segments, self, deadline, priority, cancel)
+        except gen.TimeoutError:
+            self.checkStuck()
+            raise
+        except tornado.iostream.StreamClosedError:
+            if not self.stuck:
+                # A process died; make sure the rest go too, and mark
+                # us for replacement:
+                logging.warning("Pipeline closed its output, killing it")
+                self.kill()
+            raise
+        return outputs
+
+    @gen.coroutine
+    def flushSegments(self, segments, deformat, reformat, deadline=None, priority=PRIORITIES['normal'], cancel=None):
+        """Deformat, translate and reformat a list of NUL-terminated
+        segments, keeping them apart."""
+        if deformat:
+            started = time()
+            segments = yield self.format(deformat, segments, deadline, priority, cancel)
+            self.noteStage('deformat', started)
+        segments = yield self.submit(segments, deadline, priority, cancel)
+        if reformat:
+            started = time()
+            segments = yield self.format(reformat, segments, deadline, priority, cancel)
+            self.noteStage('reformat', started)
+        return segments
+
+    @gen.coroutine
+    def flushSegment(self, data, deformat, reformat, deadline=None, priority=PRIORITIES['normal'], cancel=None):
+        if self.batch_window_ms <= 0:
+            outputs = yield self.flushSegments([data], deformat, reformat, deadline, priority, cancel)
+            return outputs[0]
+        key = (deformat, reformat)
+        if key not in self.batches:
+            self.batches[key] = Batch()
+            self.batches[key].timeout = tornado.ioloop.IOLoop.current().call_later(
+                self.batch_window_ms / 1000.0, self.flushBatch, key)
+        batch = self.batches[key]
+        future = Future()
+        batch.add(data, future, deadline, priority, cancel)
+        if batch.size >= self.batch_max_bytes:
+            tornado.ioloop.IOLoop.current().remove_timeout(batch.timeout)
+            self.flushBatch(key)
+        # The rest of the batch may have more time than we do:
+        output = yield withTimeout(None if deadline is None else deadline - time(), unlessCancelled(cancel, future))
+        return output
+
+    @gen.coroutine
+    def flushBatch(self, key):
+        batch = self.batches.pop(key)
+        deformat, reformat = key
+        # Don't spend pipeline time on segments nobody is waiting for:
+        now = time()
+        live = [i for i, (deadline, cancel) in enumerate(zip(batch.deadlines, batch.cancels))
+                if (deadline is None or deadline > now) and (cancel is None or not cancel.done())]
+        if not live:
+            return
+        deadline = None if None in batch.deadlines else max(batch.deadlines)
+        try:
+            outputs = yield self.flushSegments([batch.segments[i] for i in live], deformat, reformat, deadline,
+                                               min(batch.priorities[i] for i in live))
+        except Exception as e:
+            for i in live:
+                batch.futures[i].set_exception(e)
+        else:
+            for i, output in zip(live, outputs):
+                batch.futures[i].set_result(output)
+
     @gen.coroutine
-    def translate(self, toTranslate, nosplit=False, deformat=True, reformat=True):
+    def translate(self, toTranslate, nosplit=False, deformat=True, reformat=True, memo=None, deadline=None,
+                  priority=PRIORITIES['normal'], cancel=None):
+        """If memo is given, it should have get(sentence) and
+        put(sentence, translation) methods; we then translate sentence
+        by sentence, and only the sentences memo doesn't know yet."""
         with self.use():
-            if nosplit:
-                res = yield translateNULFlush(toTranslate, self, deformat, reformat)
+            if memo is not None:
+                res = yield self.translateSentences(toTranslate, deformat, reformat, memo, deadline, priority, cancel=cancel)
+                return res
+            elif nosplit and len(toTranslate) > PIPE_BUF:
+                # Unsplit texts can still be split once deformatted, so
+                # they don't hold up everyone else's in one big piece:
+                res = yield self.translateSentences(toTranslate, deformat, reformat, None, deadline, priority, PIPE_BUF, cancel)
+                return res
+            elif nosplit:
+                res = yield translateNULFlush(toTranslate, self, deformat, reformat, deadline, priority, cancel)
                 return res
             else:
                 all_split = splitForTranslation(toTranslate, n_users=self.users)
-                parts = yield [translateNULFlush(part, self, deformat, reformat)
-                               for part in all_split]
+                parts = yield gen.multi_future([translateNULFlush(part, self, deformat, reformat, deadline, priority, cancel)
+                                                for part in all_split], quiet_exceptions=CHUNK_ERRORS)
                 return "".join(parts)
 
+    def translateMany(self, texts, unsafe_deformat=True, unsafe_reformat=True, deadline=None, priority=PRIORITIES['normal'],
+                      cancel=None):
+        """Write short texts to the pipeline several at a time, up to
+        half the room in the pipeline per write; longer ones go through
+        translate on their own."""
+        deformat, reformat = validateFormatters(unsafe_deformat, unsafe_reformat)
+        groupBytes = self.stream.max_inflight // 2
+        futures = [None] * len(texts)
+        groups, group, size = [], [], 0
+        for i, text in enumerate(texts):
+            data = bytes(text, 'utf-8') + bytes('\0', 'utf-8')
+            if len(data) > PIPE_BUF:
+                futures[i] = self.translate(text, False, unsafe_deformat, unsafe_reformat, deadline=deadline, priority=priority,
+                                            cancel=cancel)
+                continue
+            if group and size + len(data) > groupBytes:
+                groups.append(group)
+                group, size = [], 0
+            futures[i] = Future()
+            group.append((data, futures[i]))
+            size += len(data)
+        if group:
+            groups.append(group)
+        for group in groups:
+            self.translateGroup(group, deformat, reformat, deadline, priority, cancel)
+        return futures
+
+    @gen.coroutine
+    def translateGroup(self, group, deformat, reformat, deadline, priority, cancel=None):
+        """Translate a list of (NUL-terminated segment, Future) in one
+        write, and resolve the futures."""
+        segments = [data for data, _ in group]
+        with self.use():
+            try:
+                outputs = yield self.flushSegments(segments, deformat, reformat, deadline, priority, cancel)
+            except Exception as e:
+                for _, future in group:
+                    future.set_exception(e)
+                return
+        for (_, future), output in zip(group, outputs):
+            future.set_result(re.sub(rb'\0$', b'', output).decode('utf-8'))
+
+    @gen.coroutine
+    def translateSentences(self, toTranslate, unsafe_deformat, unsafe_reformat, memo, deadline=None, priority=PRIORITIES['normal'],
+                           groupBytes=None, cancel=None):
+        """Deformat toTranslate in one go, translate its sentences in
+        writes of up to groupBytes, and reformat the result in one go.
+        memo may be None."""
+        if groupBytes is None:
+            groupBytes = self.stream.max_inflight // 2
+        deformat, reformat = validateFormatters(unsafe_deformat, unsafe_reformat)
+        deformatted = bytes(toTranslate, 'utf-8') + bytes('\0', 'utf-8')
+        if deformat:
+            started = time()
+            [deformatted] = yield self.format(deformat, [deformatted], deadline, priority, cancel)
+            self.noteStage('deformat', started)
+        pieces = splitSentences(re.sub(rb'\0$', b'', deformatted))
+
+        translated = {}  # sentence: its translation
+        unseen = []
+        for isSentence, piece in pieces:
+            if isSentence and piece not in translated:
+                translated[piece] = memo.get(piece) if memo is not None else None
+                if translated[piece] is None:
+                    unseen.append(piece)
+        # Write them groupBytes at a time, rather than one by one:
+        groups, group, size = [], [], 0
+        for sentence in unseen:
+            if group and size + len(sentence) > groupBytes:
+                groups.append(group)
+                group, size = [], 0
+            group.append(sentence + bytes('\0', 'utf-8'))
+            size += len(sentence) + 1
+        if group:
+            groups.append(group)
+        outputs = yield gen.multi_future([self.submit(group, deadline, priority, cancel) for group in groups],
+                                         quiet_exceptions=CHUNK_ERRORS)
+        outputs = [output for groupOutputs in outputs for output in groupOutputs]
+        for sentence, output in zip(unseen, outputs):
+            translated[sentence] = re.sub(rb'\0$', b'', output)
+            if memo is not None:
+                memo.put(sentence, translated[sentence])
+
+        result = b''.join(translated[piece] if isSentence else piece
+                          for isSentence, piece in pieces)
+        result += bytes('\0', 'utf-8')
+        if reformat:
+            started = time()
+            [result] = yield self.format(reformat, [result], deadline, priority, cancel)
+            self.noteStage('reformat', started)
+        return re.sub(rb'\0$', b'', result).decode('utf-8')
+
+
+class Batch(object):
+    """Segments (and their callers' futures) waiting to be written to a
+    FlushingPipeline together."""
+
+    def __init__(self):
+        self.segments = []
+        self.futures = []
+        self.deadlines = []
+        self.priorities = []
+        self.cancels = []
+        self.size = 0
+        self.timeout = None
+
+    def add(self, data, future, deadline=None, priority=PRIORITIES['normal'], cancel=None):
+        self.segments.append(data)
+        self.futures.append(future)
+        self.deadlines.append(deadline)
+        self.priorities.append(priority)
+        self.cancels.append(cancel)
+        self.size += len(data)
+
 
 class SimplePipeline(Pipeline):
 
@@ -82,24 +618,42 @@ class SimplePipeline(Pipeline):
         super().__init__(*args, **kwargs)
 
     @gen.coroutine
-    def translate(self, toTranslate, nosplit="ignored", deformat="ignored", reformat="ignored"):
+    def translate(self, toTranslate, nosplit="ignored", deformat="ignored", reformat="ignored", memo="ignored", deadline=None,
+                  priority="ignored", cancel="ignored"):
         with self.use():
-            with (yield self.lock.acquire()):
-                res = yield translateSimple(toTranslate, self.commands)
+            started = time()
+            if deadline is None:
+                lock = yield self.lock.acquire()
+            else:
+                try:
+                    lock = yield self.lock.acquire(timedelta(seconds=max(0, deadline - time())))
+                except LockTimeout:
+                    raise gen.TimeoutError("Timed out waiting for the pipeline")
+            with lock:
+                self.noteStage('queue', started)
+                started = time()
+                res = yield translateSimple(toTranslate, self.commands, deadline)
+                self.noteStage('pipeline', started)
                 return res
 
 
 ParsedModes = namedtuple('ParsedModes', 'do_flush commands')
 
 
-def makePipeline(modes_parsed):
+def makePipeline(modes_parsed, timeout=None, batch_window_ms=0, batch_max_bytes=PIPE_BUF, stageTimer=None):
     if modes_parsed.do_flush:
-        return FlushingPipeline(modes_parsed.commands)
+        return FlushingPipeline(modes_parsed.commands, batch_window_ms, batch_max_bytes,
+                                timeout=timeout, stageTimer=stageTimer)
     else:
-        return SimplePipeline(modes_parsed.commands)
+        return SimplePipeline(modes_parsed.commands, timeout=timeout, stageTimer=stageTimer)
 
 
 def startPipeline(commands):
+    procs = startProcs(commands)
+    return procs[0], procs[-1]
+
+
+def startProcs(commands):
     procs = []
     for i, cmd in enumerate(commands):
         if i == 0:
@@ -113,7 +667,7 @@ def startPipeline(commands):
         procs.append(tornado.process.Subprocess(cmd,
                                                 stdin=in_from,
                                                 stdout=out_from))
-    return procs[0], procs[-1]
+    return procs
 
 
 def cmdNeedsZ(cmd):
@@ -153,25 +707,7 @@ def parseModeFile(mode_path):
         raise Exception('Could not parse mode file %s', mode_path)
 
 
-def upToBytes(string, max_bytes):
-    """Find the unicode string length of the first up-to-max_bytes bytes.
-
-    At least it's much faster than going through the string adding
-    bytes of each char.
-
-    """
-    b = bytes(string, 'utf-8')
-    l = max_bytes
-    while l:
-        try:
-            dec = b[:l].decode('utf-8')
-            return len(dec)
-        except UnicodeDecodeError:
-            l -= 1
-    return 0
-
-
-def hardbreakFn(string, n_users):
+def hardbreakFn(n_users):
     """If others are queueing up to translate at the same time, we send
     short requests, otherwise we try to minimise the number of
     requests, but without letting buffers fill up.
@@ -182,50 +718,93 @@ def hardbreakFn(string, n_users):
     if n_users > 2:
         return 1000
     else:
-        return upToBytes(string, PIPE_BUF)
+        return PIPE_BUF
 
 
-def preferPunctBreak(string, last, hardbreak):
-    """We would prefer to split on a period or space seen before the
-    hardbreak, if we can. If the remaining string is smaller or equal
-    than the hardbreak, return end of the string
+def preferPunctBreak(encoded, last, hardbreak):
+    """We would prefer to split on a period or space seen in the second
+    half of the hardbreak bytes after last, if we can. If what's left
+    fits in hardbreak, return the end of the string; failing all else,
+    return the last character boundary before the hardbreak.
 
     """
-
-    if(len(string[last:]) <= hardbreak):
-        return last + hardbreak + 1
-
-    softbreak = int(hardbreak / 2) + 1
-    softnext = last + softbreak
+    if len(encoded) - last <= hardbreak:
+        return len(encoded)
+    softnext = last + hardbreak // 2 + 1
     hardnext = last + hardbreak
-    dot = string.rfind(".", softnext, hardnext)
+    dot = encoded.rfind(b'.', softnext, hardnext)
     if dot > -1:
         return dot + 1
-    else:
-        space = string.rfind(" ", softnext, hardnext)
-        if space > -1:
-            return space + 1
-        else:
-            return hardnext
+    space = encoded.rfind(b' ', softnext, hardnext)
+    if space > -1:
+        return space + 1
+    # Don't cut a character in two (continuation bytes are 10xxxxxx):
+    next = hardnext
+    while next > last + 1 and encoded[next] & 0xC0 == 0x80:
+        next -= 1
+    return next
 
 
 def splitForTranslation(toTranslate, n_users):
     """Splitting it up a bit ensures we don't fill up FIFO buffers (leads
-    to processes hanging on read/write)."""
+    to processes hanging on read/write).
+
+    We encode the text once and split it into chunks of at most
+    hardbreakFn(n_users) bytes (unless a single character is longer),
+    so this takes time linear in the length of the text, and no text is
+    ever left out.
+
+    """
+    encoded = bytes(toTranslate, 'utf-8')
+    view = memoryview(encoded)
+    hardbreak = hardbreakFn(n_users)
     allSplit = []              # [].append and join faster than str +=
     last = 0
-    rounds = 0
-    while last < len(toTranslate) and rounds < 10:
-        rounds += 1
-        hardbreak = hardbreakFn(toTranslate[last:], n_users)
-        next = preferPunctBreak(toTranslate, last, hardbreak)
-        allSplit.append(toTranslate[last:next])
-        # logging.getLogger().setLevel(logging.DEBUG)
-        logging.debug("splitForTranslation: last:%s hardbreak:%s next:%s appending:%s" % (last, hardbreak, next, toTranslate[last:next]))
+    while last < len(encoded):
+        next = preferPunctBreak(encoded, last, hardbreak)
+        allSplit.append(str(view[last:next], 'utf-8'))
         last = next
     return allSplit
 
 
+# Tokens of the deformatted stream: group 1 is blanks and superblanks,
+# group 2 is (a bit of) text
+sentenceTokenRE = re.compile(rb'(\[(?:\\.|[^\\\]])*\]|\s+)|(\\.|[^\[\\\s]+|.)', re.S)
+sentenceEndRE = re.compile(rb'[.!?]$')
+
+
+def splitSentences(deformatted):
+    """Split deformatted text into a list of (isSentence, piece).
+
+    A sentence ends with text ending in sentence-final punctuation;
+    any blanks and superblanks that follow it (or that start the
+    text) become pieces of their own, to be left as they are.
+    Joining the pieces gives back the text.
+
+    """
+    pieces = []
+    sentence, gap = [], []
+    ended = True
+    for m in sentenceTokenRE.finditer(deformatted):
+        blank, text = m.group(1), m.group(2)
+        if blank is not None:
+            (gap if ended else sentence).append(blank)
+            continue
+        if ended:
+            if sentence:
+                pieces.append((True, b''.join(sentence)))
+            if gap:
+                pieces.append((False, b''.join(gap)))
+            sentence, gap = [], []
+        sentence.append(text)
+        ended = not text.startswith(b'\\') and sentenceEndRE.search(text) is not None
+    if sentence:
+        pieces.append((True, b''.join(sentence)))
+    if gap:
+        pieces.append((False, b''.join(gap)))
+    return pieces
+
+
 def validateFormatters(deformat, reformat):
     def valid1(elt, lst):
         if elt in lst:
@@ -247,48 +826,64 @@ def checkRetCode(name, proc):
         raise ProcessFailure("%s failed, exit code %s", name, proc.returncode)
 
 
+def withTimeout(timeout, future):
+    """Like gen.with_timeout, but taking seconds, and None for no timeout."""
+    if timeout is None:
+        return future
+    # Whoever raised the TimeoutError kills the process, so the
+    # abandoned future will fail with a closed stream:
+    return gen.with_timeout(timedelta(seconds=timeout), future,
+                            quiet_exceptions=(tornado.iostream.StreamClosedError,))
+
+
 @gen.coroutine
-def translateNULFlush(toTranslate, pipeline, unsafe_deformat, unsafe_reformat):
-    with (yield pipeline.lock.acquire()):
-        proc_in, proc_out = pipeline.inpipe, pipeline.outpipe
-        deformat, reformat = validateFormatters(unsafe_deformat, unsafe_reformat)
+def runCommand(name, cmd, data, timeout=None):
+    """Like Popen.communicate, but without blocking the IOLoop; kills
+    the process if it takes more than timeout seconds."""
+    proc = tornado.process.Subprocess(cmd,
+                                      stdin=tornado.process.Subprocess.STREAM,
+                                      stdout=tornado.process.Subprocess.STREAM)
 
-        if deformat:
-            proc_deformat = Popen(deformat, stdin=PIPE, stdout=PIPE)
-            proc_deformat.stdin.write(bytes(toTranslate, 'utf-8'))
-            deformatted = proc_deformat.communicate()[0]
-            checkRetCode("Deformatter", proc_deformat)
-        else:
-            deformatted = bytes(toTranslate, 'utf-8')
+    @gen.coroutine
+    def communicate():
+        # Start reading before writing, or a large input could fill
+        # up the output pipe while we wait for the write to finish:
+        reading = proc.stdout.read_until_close()
+        yield gen.Task(proc.stdin.write, data)
+        proc.stdin.close()
+        output = yield reading
+        yield proc.wait_for_exit(raise_error=False)
+        return output
+
+    try:
+        output = yield withTimeout(timeout, communicate())
+    except gen.TimeoutError:
+        logging.warning("%s timed out after %s secs, killing it", name, timeout)
+        proc.proc.kill()
+        proc.stdin.close()
+        proc.stdout.close()
+        raise
+    checkRetCode(name, proc)
+    return output
 
-        proc_in.stdin.write(deformatted)
-        proc_in.stdin.write(bytes('\0', "utf-8"))
-        # TODO: PipeIOStream has no flush, but seems to work anyway?
-        # proc_in.stdin.flush()
 
-        # TODO: If the output has no \0, this hangs, locking the
-        # pipeline. If there's no way to put a timeout right here, we
-        # might need a timeout using Pipeline.use(), like servlet.py's
-        # cleanable but called *before* trying to translate anew
-        output = yield gen.Task(proc_out.stdout.read_until, bytes('\0', 'utf-8'))
+@gen.coroutine
+def translateNULFlush(toTranslate, pipeline, unsafe_deformat, unsafe_reformat, deadline=None, priority=PRIORITIES['normal'],
+                      cancel=None):
+    # No need to lock the pipeline; pipeline.stream keeps track of
+    # whose output is whose, so chunks can be in flight together.
+    deformat, reformat = validateFormatters(unsafe_deformat, unsafe_reformat)
 
-        if reformat:
-            proc_reformat = Popen(reformat, stdin=PIPE, stdout=PIPE)
-            proc_reformat.stdin.write(output)
-            result = proc_reformat.communicate()[0]
-            checkRetCode("Reformatter", proc_reformat)
-        else:
-            result = re.sub(rb'\0$', b'', output)
-        return result.decode('utf-8')
+    toDeformat = bytes(toTranslate, 'utf-8') + bytes('\0', 'utf-8')
+    result = yield pipeline.flushSegment(toDeformat, deformat, reformat, deadline, priority, cancel)
+    return re.sub(rb'\0$', b'', result).decode('utf-8')
 
 
 @gen.coroutine
-def translatePipeline(toTranslate, commands):
+def translatePipeline(toTranslate, commands, timeout=None):
 
-    proc_deformat = Popen("apertium-deshtml", stdin=PIPE, stdout=PIPE)
-    proc_deformat.stdin.write(bytes(toTranslate, 'utf-8'))
-    deformatted = proc_deformat.communicate()[0]
-    checkRetCode("Deformatter", proc_deformat)
+    deformatted = yield runCommand("Deformatter", ["apertium-deshtml"],
+                                   bytes(toTranslate, 'utf-8'), timeout)
 
     towrite = deformatted
 
@@ -300,18 +895,13 @@ def translatePipeline(toTranslate, commands):
     all_cmds.append("apertium-deshtml")
 
     for cmd in commands:
-        proc = Popen(cmd, stdin=PIPE, stdout=PIPE)
-        proc.stdin.write(towrite)
-        towrite = proc.communicate()[0]
-        checkRetCode(" ".join(cmd), proc)
+        towrite = yield runCommand(" ".join(cmd), cmd, towrite, timeout)
 
         output.append(towrite.decode('utf-8'))
         all_cmds.append(cmd)
 
-    proc_reformat = Popen("apertium-rehtml-noent", stdin=PIPE, stdout=PIPE)
-    proc_reformat.stdin.write(towrite)
-    towrite = proc_reformat.communicate()[0].decode('utf-8')
-    checkRetCode("Reformatter", proc_reformat)
+    towrite = yield runCommand("Reformatter", ["apertium-rehtml-noent"], towrite, timeout)
+    towrite = towrite.decode('utf-8')
 
     output.append(towrite)
     all_cmds.append("apertium-rehtml-noent")
@@ -320,13 +910,27 @@ def translatePipeline(toTranslate, commands):
 
 
 @gen.coroutine
-def translateSimple(toTranslate, commands):
+def translateSimple(toTranslate, commands, deadline=None):
+    """Kills the pipeline if it's not done by deadline (if given)."""
     proc_in, proc_out = startPipeline(commands)
     assert proc_in == proc_out
-    yield gen.Task(proc_in.stdin.write, bytes(toTranslate, 'utf-8'))
-    proc_in.stdin.close()
-    translated = yield gen.Task(proc_out.stdout.read_until_close)
-    proc_in.stdout.close()
+
+    @gen.coroutine
+    def communicate():
+        yield gen.Task(proc_in.stdin.write, bytes(toTranslate, 'utf-8'))
+        proc_in.stdin.close()
+        translated = yield gen.Task(proc_out.stdout.read_until_close)
+        proc_in.stdout.close()
+        return translated
+
+    try:
+        translated = yield withTimeout(None if deadline is None else deadline - time(), communicate())
+    except gen.TimeoutError:
+        logging.warning("Pipeline timed out, killing it")
+        proc_in.proc.kill()
+        proc_in.stdin.close()
+        proc_in.stdout.close()
+        raise
     return translated.decode('utf-8')
 
 
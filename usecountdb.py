@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 sts=4 et :
+
+import sqlite3
+import logging
+import threading
+from collections import defaultdict
+from contextlib import closing
+
+
+class UseCountDb(object):
+    """How many translation requests each pair has had, kept across
+    restarts so we know which pairs to pre-warm. Processes started
+    with -j all add their counts to the same database."""
+
+    def __init__(self, dbPath, memlimit=100):
+        self.lock = threading.RLock()
+        self.conn = None
+        self.dbPath = dbPath
+        self.counts = defaultdict(lambda: 0)  # pair: uses not yet committed
+        self.uses = 0
+        self.memlimit = memlimit
+
+    def connect(self):
+        if not self.conn:
+            self.conn = sqlite3.connect(self.dbPath, timeout=5)
+            with closing(self.conn.cursor()) as c:
+                c.execute("PRAGMA synchronous = NORMAL")
+                c.execute('CREATE TABLE IF NOT EXISTS useCounts (pair TEXT PRIMARY KEY, count INTEGER)')
+        return self.conn
+
+    def noteUse(self, pair):
+        self.counts[pair] += 1
+        self.uses += 1
+        if self.uses > self.memlimit:
+            self.commit()
+
+    def commit(self):
+        if not self.counts:
+            return
+        with self.lock:
+            try:
+                conn = self.connect()
+                with closing(conn.cursor()) as c:
+                    c.executemany(
+                        'INSERT OR REPLACE INTO useCounts VALUES (:pair, COALESCE((SELECT count FROM useCounts WHERE pair=:pair), 0) + :amount)',
+                        ({'pair': pair, 'amount': amount} for pair, amount in self.counts.items()))
+                conn.commit()
+            except sqlite3.Error as e:
+                logging.warning('Could not save pair use counts to %s: %s', self.dbPath, e)
+                return
+            self.counts.clear()
+            self.uses = 0
+
+    def top(self, n):
+        """The n most used pairs, most used first."""
+        with self.lock:
+            try:
+                with closing(self.connect().cursor()) as c:
+                    c.execute('SELECT pair FROM useCounts ORDER BY count DESC LIMIT ?', (n, ))
+                    return [pair for pair, in c.fetchall()]
+            except sqlite3.Error as e:
+                logging.warning('Could not read pair use counts from %s: %s', self.dbPath, e)
+                return []
+
+    def closeDb(self):
+        self.commit()
+        if self.conn:
+            self.conn.close()
+            self.conn = None
@@ -5,7 +5,6 @@ import sqlite3
 import re
 import os
 import logging
-from subprocess import Popen, PIPE
 from datetime import datetime
 from missingdb import timedeltaToMilliseconds
 from wiki_util import wikiGetPage, wikiEditPage, wikiAddText
@@ -75,26 +74,6 @@ def getLocalizedLanguages(locale, dbPath, languages=[]):
     return output
 
 
-def apertium(input, modeDir, mode, formatting='txt'):
-    p1 = Popen(['echo', input], stdout=PIPE)
-    logging.getLogger().info("util.apertium({}, {}, {}, {})"
-                             .format(repr(input), repr(modeDir),
-                                     repr(mode), repr(formatting)))
-    cmd = ['apertium', '-d', modeDir, '-f', formatting, mode]
-    p2 = Popen(cmd, stdin=p1.stdout, stdout=PIPE)
-    p1.stdout.close()
-    output = p2.communicate()[0].decode('utf-8')
-    return output
-
-
-def bilingualTranslate(toTranslate, modeDir, mode):
-    p1 = Popen(['echo', toTranslate], stdout=PIPE)
-    p2 = Popen(['lt-proc', '-b', mode], stdin=p1.stdout, stdout=PIPE, cwd=modeDir)
-    p1.stdout.close()
-    output = p2.communicate()[0].decode('utf-8')
-    return output
-
-
 def removeDotFromDeformat(query, analyses):
     """When using the txt format, a dot is added at EOF (also, double line
     breaks) if the last part of the query isn't itself a dot"""
@@ -111,15 +90,10 @@ def stripTags(analysis):
         return analysis
 
 
-def getCoverages(text, modes, penalize=False):
-    coverages = {}
-    for mode, modeTuple in modes.items():
-        coverages[mode] = getCoverage(text, modeTuple[0], modeTuple[1], penalize=penalize)
-    return coverages
-
-
-def getCoverage(text, mode, modeDir, penalize=False):
-    analysis = apertium(text, mode, modeDir)
+def calcCoverage(text, analysis, penalize=False):
+    """The share of the lexical units of analysis (text through an
+    analyzer, with the txt format) that are known; if penalize, less
+    the share of text that isn't in any lexical unit."""
     lexicalUnits = removeDotFromDeformat(text, re.findall(r'\^([^\$]*)\$([^\^]*)', analysis))
     analyzedLexicalUnits = list(filter(lambda x: not x[0].split('/')[1][0] in '*&#', lexicalUnits))
     if len(lexicalUnits) and not penalize:
@@ -130,61 +104,6 @@ def getCoverage(text, mode, modeDir, penalize=False):
         return -1
 
 
-def processPerWord(analyzers, taggers, lang, modes, query):
-    outputs = {}
-    morph_lexicalUnits = None
-    tagger_lexicalUnits = None
-    lexicalUnitRE = r'\^([^\$]*)\$'
-
-    if 'morph' in modes or 'biltrans' in modes:
-        if lang in analyzers:
-            modeInfo = analyzers[lang]
-            analysis = apertium(query, modeInfo[0], modeInfo[1])
-            morph_lexicalUnits = removeDotFromDeformat(query, re.findall(lexicalUnitRE, analysis))
-            outputs['morph'] = [lexicalUnit.split('/')[1:] for lexicalUnit in morph_lexicalUnits]
-            outputs['morph_inputs'] = [stripTags(lexicalUnit.split('/')[0]) for lexicalUnit in morph_lexicalUnits]
-        else:
-            return
-
-    if 'tagger' in modes or 'disambig' in modes or 'translate' in modes:
-        if lang in taggers:
-            modeInfo = taggers[lang]
-            analysis = apertium(query, modeInfo[0], modeInfo[1])
-            tagger_lexicalUnits = removeDotFromDeformat(query, re.findall(lexicalUnitRE, analysis))
-            outputs['tagger'] = [lexicalUnit.split('/')[1:] if '/' in lexicalUnit else lexicalUnit for lexicalUnit in tagger_lexicalUnits]
-            outputs['tagger_inputs'] = [stripTags(lexicalUnit.split('/')[0]) for lexicalUnit in tagger_lexicalUnits]
-        else:
-            return
-
-    if 'biltrans' in modes:
-        if morph_lexicalUnits:
-            outputs['biltrans'] = []
-            for lexicalUnit in morph_lexicalUnits:
-                splitUnit = lexicalUnit.split('/')
-                forms = splitUnit[1:] if len(splitUnit) > 1 else splitUnit
-                rawTranslations = bilingualTranslate(''.join(['^%s$' % form for form in forms]), modeInfo[0], lang + '.autobil.bin')
-                translations = re.findall(lexicalUnitRE, rawTranslations)
-                outputs['biltrans'].append(list(map(lambda x: '/'.join(x.split('/')[1:]), translations)))
-                outputs['translate_inputs'] = outputs['morph_inputs']
-        else:
-            return
-
-    if 'translate' in modes:
-        if tagger_lexicalUnits:
-            outputs['translate'] = []
-            for lexicalUnit in tagger_lexicalUnits:
-                splitUnit = lexicalUnit.split('/')
-                forms = splitUnit[1:] if len(splitUnit) > 1 else splitUnit
-                rawTranslations = bilingualTranslate(''.join(['^%s$' % form for form in forms]), modeInfo[0], lang + '.autobil.bin')
-                translations = re.findall(lexicalUnitRE, rawTranslations)
-                outputs['translate'].append(list(map(lambda x: '/'.join(x.split('/')[1:]), translations)))
-                outputs['translate_inputs'] = outputs['tagger_inputs']
-        else:
-            return
-
-    return (outputs, tagger_lexicalUnits, morph_lexicalUnits)
-
-
 def getTimestamp():
     return datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
 
@@ -204,8 +123,8 @@ def scaleMtLog(status, time, tInfo, key, length):
 
 
 class TranslationInfo:
-    def __init__(self, handler):
-        self.langpair = handler.get_argument('langpair')
+    def __init__(self, handler, langpair=None):
+        self.langpair = langpair if langpair is not None else handler.get_argument('langpair')
         self.key = handler.get_argument('key', default='null')
         self.ip = handler.request.headers.get('X-Real-IP', handler.request.remote_ip)
         self.referer = handler.request.headers.get('Referer', 'null')